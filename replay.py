@@ -0,0 +1,373 @@
+"""
+Воспроизведение записанного трафика вебхуков (CAPTURE_PATH в server.py) против экземпляра моста.
+
+Мост запускается с фейковыми Bitrix и Telegram, которые поднимает этот скрипт. Каждую сборку —
+с чистым состоянием: без снимка (иначе сборка B загрузит привязки, сохранённые сборкой A при выходе),
+со своим журналом, без сверки и bootstrap — они шлют в upstream вызовы, которых нет в записи.
+Планировщик вызовов выключен: с лимитом Bitrix 2 rps прогон на --speed max мерил бы очередь, а не сборку:
+
+    BITRIX_REST_API_URL=http://127.0.0.1:18080/rest/ TELEGRAM_API_BASE=http://127.0.0.1:18080 \\
+    TELEGRAM_BOT_TOKEN=replay WEBHOOK_RATE_PER_SEC=100000 WEBHOOK_RATE_BURST=100000 \\
+    STATE_SNAPSHOT_ENABLED=0 JOURNAL_PATH=$(mktemp -d)/journal.sqlite3 RECONCILE_ENABLED=0 AUTO_BOOTSTRAP=0 \\
+    SCHED_ENABLED=0 \\
+    python server.py
+
+Перед прогоном скрипт проверяет это через /debug/* моста и предупреждает (см. warnings в отчёте).
+
+    python replay.py run capture.jsonl.gz --target http://127.0.0.1:10000 --speed 1 --out a.json
+    python replay.py run capture.jsonl.gz --target http://127.0.0.1:10000 --speed max --out b.json
+    python replay.py compare a.json b.json
+
+--speed: 1 — в реальном темпе, N — в N раз быстрее, max — без пауз (ограничено --concurrency).
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import requests
+
+
+# ----------------------
+# Фейковые Bitrix REST и Telegram Bot API: правдоподобные ответы + счётчик вызовов
+# ----------------------
+
+class _FakeUpstreams:
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.calls: Counter = Counter()
+        self._ids = iter(range(1_000_000, 10_000_000))
+        self._lock = threading.Lock()
+
+    def next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def count(self, key: str):
+        with self._lock:
+            self.calls[key] += 1
+
+    def bitrix_result(self, method: str, body: dict):
+        if method == "tasks.task.add":
+            return {"task": {"id": self.next_id()}}
+        if method in {"task.commentitem.add", "tasks.task.comment.add", "im.message.add", "imbot.message.add"}:
+            return self.next_id()
+        if method == "tasks.task.list":
+            return {"tasks": []}
+        if method == "event.offline.get":
+            return {"process_id": "replay", "events": []}
+        if method == "imbot.bot.list":
+            return []
+        if method == "app.info":
+            return {"scope": ["imbot", "im", "task"]}
+        if method == "batch":
+            results = {}
+            for key, cmd in (body.get("cmd") or {}).items():
+                sub_method = str(cmd).split("?", 1)[0]
+                self.count(f"bitrix.batch:{sub_method}")
+                results[key] = self.bitrix_result(sub_method, {})
+            return {"result": results, "result_error": []}
+        return True
+
+    def telegram_result(self, method: str):
+        if method in {"sendMessage", "editMessageText"}:
+            return {"message_id": self.next_id()}
+        return True
+
+
+def _make_handler(fakes: _FakeUpstreams):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, payload: dict):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.do_POST()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                body = dict(parse_qsl(raw.decode("utf-8", errors="replace")))
+            if fakes.latency_ms:
+                time.sleep(fakes.latency_ms / 1000 * random.uniform(0.5, 1.5))
+            path = urlparse(self.path).path
+            method = path.rstrip("/").rsplit("/", 1)[-1]
+            if path.startswith("/bot"):
+                fakes.count(f"telegram.{method}")
+                self._reply({"ok": True, "result": fakes.telegram_result(method)})
+            else:
+                fakes.count(f"bitrix.{method}")
+                self._reply({"result": fakes.bitrix_result(method, body if isinstance(body, dict) else {})})
+
+    return Handler
+
+
+# ----------------------
+# Воспроизведение
+# ----------------------
+
+def load_capture(path: str) -> list[dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    records = []
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+def _with_secrets(record: dict, telegram_secret: str | None, bitrix_token: str | None) -> tuple[dict, bytes]:
+    headers = {"Content-Type": record.get("content_type") or "application/json"}
+    body = record.get("body") or ""
+    if record["path"].startswith("/telegram/") and telegram_secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = telegram_secret
+    elif bitrix_token:
+        # Токен приложения вырезан при записи — подставляем заново
+        if headers["Content-Type"].startswith("application/x-www-form-urlencoded"):
+            body = urlencode(parse_qsl(body, keep_blank_values=True) + [("auth[application_token]", bitrix_token)])
+        else:
+            try:
+                data = json.loads(body or "{}")
+                data["auth"] = {"application_token": bitrix_token}
+                body = json.dumps(data, ensure_ascii=False)
+            except (ValueError, TypeError):
+                pass
+    return headers, body.encode("utf-8")
+
+
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pct(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 2)
+
+    return {
+        "p50": pct(0.5),
+        "p90": pct(0.9),
+        "p99": pct(0.99),
+        "max": round(ordered[-1], 2),
+        "mean": round(sum(ordered) / len(ordered), 2),
+    }
+
+
+_SHARED_JOURNAL_PATH = os.path.join(".state", "bitrix_bridge_journal.sqlite3")  # путь по умолчанию в server.py
+
+
+def preflight(target: str, timeout: float = 5.0) -> list[str]:
+    # Состояние, переживающее перезапуск или порождающее свой трафик, искажает сравнение сборок
+    base = target.rstrip("/")
+
+    def get(path: str) -> dict | None:
+        try:
+            r = requests.get(f"{base}{path}", timeout=timeout)
+            return r.json() if r.ok else None
+        except (requests.RequestException, ValueError):
+            return None
+
+    warnings = []
+    snapshot = get("/debug/snapshot")
+    if snapshot is None:
+        warnings.append("admin-маршруты недоступны — изоляцию моста проверить нельзя")
+        return warnings
+    if snapshot.get("enabled"):
+        warnings.append(f"снимок состояния включён ({snapshot.get('path')}): задайте STATE_SNAPSHOT_ENABLED=0")
+    if snapshot.get("loaded_from"):
+        warnings.append(f"мост стартовал с привязками из снимка {snapshot['loaded_from']}")
+    journal = get("/debug/journal") or {}
+    if journal.get("enabled") and str(journal.get("path", "")).endswith(_SHARED_JOURNAL_PATH):
+        warnings.append(f"журнал пишется в путь по умолчанию {journal['path']}: задайте временный JOURNAL_PATH")
+    if (get("/debug/reconcile") or {}).get("enabled"):
+        warnings.append("сверка привязок включена: задайте RECONCILE_ENABLED=0")
+    scheduler = get("/debug/scheduler") or {}
+    if scheduler.get("enabled"):
+        rate = (scheduler.get("bitrix") or {}).get("rate_per_sec")
+        warnings.append(f"планировщик вызовов включён (Bitrix {rate} rps): задайте SCHED_ENABLED=0")
+    if (get("/debug/startup") or {}).get("auto_bootstrap"):
+        warnings.append("bootstrap при первом запросе включён: задайте AUTO_BOOTSTRAP=0")
+    mappings = get("/debug/mappings") or {}
+    if mappings.get("chat_to_task"):
+        warnings.append(f"у моста уже есть {len(mappings['chat_to_task'])} привязок чат→задача")
+    return warnings
+
+
+def run_replay(args) -> dict:
+    records = load_capture(args.capture)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        raise SystemExit("❌ В файле нет записей")
+
+    warnings = preflight(args.target)
+    for w in warnings:
+        print(f"⚠️ {w}")
+
+    fakes = _FakeUpstreams(latency_ms=args.fake_latency_ms)
+    server = ThreadingHTTPServer(("127.0.0.1", args.fake_port), _make_handler(fakes))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"🧪 Фейковые Bitrix/Telegram на http://127.0.0.1:{args.fake_port}")
+
+    speed = None if args.speed == "max" else float(args.speed)
+    session = requests.Session()
+    latencies: list[float] = []
+    lags: list[float] = []
+    statuses: Counter = Counter()
+    lock = threading.Lock()
+
+    def send(record: dict, scheduled: float):
+        headers, body = _with_secrets(record, args.telegram_secret, args.bitrix_token)
+        url = f"{args.target.rstrip('/')}{record['path']}"
+        if record.get("query"):
+            url = f"{url}?{record['query']}"
+        started = time.perf_counter()
+        try:
+            r = session.request(record.get("method") or "POST", url, data=body, headers=headers, timeout=args.timeout)
+            status = str(r.status_code)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed_ms)
+            lags.append(max(0.0, (started - scheduled) * 1000))
+            statuses[status] += 1
+
+    t0 = records[0]["t"]
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for record in records:
+            scheduled = wall_start if speed is None else wall_start + (record["t"] - t0) / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, record, scheduled)
+    duration = time.perf_counter() - wall_start
+    # Мост может досылать запросы в фоне (журнал, рассылки) — даём им завершиться
+    time.sleep(args.settle)
+    server.shutdown()
+
+    report = {
+        "capture": args.capture,
+        "target": args.target,
+        "speed": args.speed,
+        "requests": len(records),
+        "duration_sec": round(duration, 3),
+        "throughput_rps": round(len(records) / duration, 2) if duration else None,
+        "status_counts": dict(statuses),
+        "latency_ms": _percentiles(latencies),
+        "schedule_lag_ms": _percentiles(lags),
+        "upstream_total": sum(v for k, v in fakes.calls.items() if ":" not in k),
+        "upstream": dict(sorted(fakes.calls.items())),
+        "warnings": warnings,
+    }
+    return report
+
+
+def compare_reports(a: dict, b: dict, max_p99_regression: float) -> int:
+    print(f"{'':28} {'A':>12} {'B':>12} {'Δ':>10}")
+
+    def row(name: str, va, vb):
+        delta = "" if va in (None, "") or vb in (None, "") else f"{(vb - va):+.2f}"
+        print(f"{name:28} {str(va):>12} {str(vb):>12} {delta:>10}")
+
+    row("throughput_rps", a.get("throughput_rps"), b.get("throughput_rps"))
+    for key in ("p50", "p90", "p99", "max"):
+        row(f"latency_ms.{key}", a["latency_ms"].get(key), b["latency_ms"].get(key))
+    row("upstream_total", a.get("upstream_total"), b.get("upstream_total"))
+
+    failed = False
+    upstream_diff = {}
+    for key in sorted(set(a["upstream"]) | set(b["upstream"])):
+        va, vb = a["upstream"].get(key, 0), b["upstream"].get(key, 0)
+        if va != vb:
+            upstream_diff[key] = (va, vb)
+    if upstream_diff:
+        failed = True
+        print("\n⚠️ Различия в вызовах upstream:")
+        for key, (va, vb) in upstream_diff.items():
+            row(key, va, vb)
+    if a.get("status_counts") != b.get("status_counts"):
+        failed = True
+        print(f"\n⚠️ Различаются коды ответов: {a.get('status_counts')} → {b.get('status_counts')}")
+
+    p99_a, p99_b = a["latency_ms"].get("p99"), b["latency_ms"].get("p99")
+    if p99_a and p99_b and p99_b > p99_a * (1 + max_p99_regression):
+        failed = True
+        print(f"\n⚠️ p99 вырос на {round((p99_b / p99_a - 1) * 100, 1)}% (порог {round(max_p99_regression * 100)}%)")
+    for name, report in (("A", a), ("B", b)):
+        if report.get("warnings"):
+            print(f"\n⚠️ Прогон {name} шёл с общим состоянием — различия могут быть ложными:")
+            for w in report["warnings"]:
+                print(f"   - {w}")
+    if not failed:
+        print("\n✅ Различий не найдено")
+    return 1 if failed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных вебхуков против моста Bitrix↔Telegram")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="воспроизвести запись и сохранить отчёт")
+    run.add_argument("capture", help="файл записи (CAPTURE_PATH), .jsonl или .jsonl.gz")
+    run.add_argument("--target", default="http://127.0.0.1:10000", help="адрес экземпляра моста")
+    run.add_argument("--speed", default="1", help="1, N (ускорение) или max")
+    run.add_argument("--concurrency", type=int, default=32)
+    run.add_argument("--fake-port", type=int, default=18080, help="порт фейковых Bitrix/Telegram")
+    run.add_argument("--fake-latency-ms", type=float, default=0.0, help="средняя задержка фейковых upstream")
+    run.add_argument("--telegram-secret", help="подставить X-Telegram-Bot-Api-Secret-Token")
+    run.add_argument("--bitrix-token", help="подставить auth[application_token]")
+    run.add_argument("--timeout", type=float, default=30.0)
+    run.add_argument("--settle", type=float, default=1.0, help="пауза перед сбором счётчиков upstream, с")
+    run.add_argument("--limit", type=int, help="воспроизвести только первые N запросов")
+    run.add_argument("--out", help="куда сохранить отчёт JSON")
+
+    cmp_ = sub.add_parser("compare", help="сравнить два отчёта (например, две сборки)")
+    cmp_.add_argument("a")
+    cmp_.add_argument("b")
+    cmp_.add_argument("--max-p99-regression", type=float, default=0.2, help="допустимый рост p99, доля")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        if args.speed != "max":
+            try:
+                if float(args.speed) <= 0:
+                    raise ValueError
+            except ValueError:
+                parser.error("--speed must be a positive number or 'max'")
+        report = run_replay(args)
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        print(text)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                f.write(text)
+        return 0
+
+    with open(args.a, encoding="utf-8") as fa, open(args.b, encoding="utf-8") as fb:
+        return compare_reports(json.load(fa), json.load(fb), args.max_p99_regression)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
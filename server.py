@@ -1,17 +1,53 @@
-from flask import Flask, request, redirect, jsonify
-import requests
+import time
+
+_startup_t0 = time.perf_counter()
+
+from flask import Blueprint, Flask, current_app, request, redirect, jsonify
 import os
 import json
+import atexit
+import gzip
+import hashlib
+import hmac
+import mmap
+import random
+import signal
+import sqlite3
+import string
+import struct
+import threading
+import uuid
+import queue
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
+from urllib.parse import parse_qsl, urlencode
+
+# Профиль холодного старта: импорт, сборка приложения, первый запрос (см. /debug/startup)
+_startup_profile: dict = {}
+
+# requests импортируем сразу: ленивый импорт лишь переносит эту задержку на первый вебхук
+_requests_t0 = time.perf_counter()
+import requests
+_startup_profile["requests_import_ms"] = round((time.perf_counter() - _requests_t0) * 1000, 2)
+
+# Основные маршруты моста (вебхуки, OAuth) и служебные/админские маршруты — см. create_app()
+bridge = Blueprint("bridge", __name__)
+admin = Blueprint("admin", __name__)
 
-app = Flask(__name__)
 _memory_token_cache = {
     "access_token": None,
     "raw": None,
 }
 _task_to_chat_map: dict[str, str] = {}
 _chat_to_task_map: dict[str, str] = {}
+_chat_predecessor: dict[str, str] = {}  # chat_id -> закрытая задача; продолжение создаётся при следующем сообщении
+_mapping_lock = threading.Lock()  # изменения и обход карт привязок (вебхуки, сверка, /chat/*)
 _bot_state: dict[str, str | None] = {"bot_id": None}
+_tg_ack_cache: "OrderedDict[str, dict]" = OrderedDict()  # chat_id -> {message_id, last_sent, suppressed, acks, pending_text, timer, lock}
+_tg_ack_lock = threading.Lock()
 _did_bootstrap = False
 
 # Загружаем переменные окружения
@@ -21,9 +57,18 @@ BITRIX_DOMAIN = os.getenv("BITRIX_DOMAIN", "https://dom.mesopharm.ru")
 REDIRECT_URI = os.getenv("BITRIX_OAUTH_REDIRECT_URI", "https://bitrix-bot-537z.onrender.com/oauth/bitrix/callback")
 RENDER_URL = "https://bitrix-bot-537z.onrender.com"
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")  # для replay.py — фейковый Telegram
 TELEGRAM_NOTIFY_CHAT_ID = os.getenv("TELEGRAM_NOTIFY_CHAT_ID")  # куда слать входящие из Bitrix IM
 FORWARD_TELEGRAM_TO_IM = os.getenv("FORWARD_TELEGRAM_TO_IM", "1")  # "1" to forward Telegram -> Bitrix IM
 BITRIX_IM_DIALOG_ID = os.getenv("BITRIX_IM_DIALOG_ID", "19508")  # куда слать из Telegram в Bitrix IM
+TASK_RESPONSIBLE_ID = int(os.getenv("TASK_RESPONSIBLE_ID", "19508"))  # ответственный за задачи из Telegram
+# Подтверждения в Telegram: message (новое сообщение), edit (правим одно статусное), reaction,
+# debounce (не чаще раза в окно; по закрытию окна — одно итоговое подтверждение). Ошибки — всегда отдельно
+TELEGRAM_ACK_MODE = os.getenv("TELEGRAM_ACK_MODE", "message").lower()
+TELEGRAM_ACK_PIN = os.getenv("TELEGRAM_ACK_PIN", "0")  # "1" — закреплять статусное сообщение в режиме edit
+TELEGRAM_ACK_DEBOUNCE_SEC = float(os.getenv("TELEGRAM_ACK_DEBOUNCE_SEC", "30"))
+TELEGRAM_ACK_REACTION = os.getenv("TELEGRAM_ACK_REACTION", "👍")
+TELEGRAM_ACK_CACHE_SIZE = int(os.getenv("TELEGRAM_ACK_CACHE_SIZE", "1000"))
 BITRIX_ENV_ACCESS_TOKEN = os.getenv("BITRIX_ACCESS_TOKEN")
 BITRIX_ENV_REFRESH_TOKEN = os.getenv("BITRIX_REFRESH_TOKEN")
 BITRIX_ENV_REST_BASE = os.getenv("BITRIX_REST_BASE")  # e.g. https://dom.mesopharm.ru/rest/
@@ -36,10 +81,89 @@ BITRIX_BOT_NAME = os.getenv("BITRIX_BOT_NAME", "Бот Тест")
 BITRIX_REST_API_URL = os.getenv("BITRIX_REST_API_URL", "https://dom.mesopharm.ru/rest/19508/i954zqjiioywm5gm/")
 BITRIX_WEBHOOK_TOKEN = os.getenv("BITRIX_WEBHOOK_TOKEN", "7qpikl02vedc6so1utbrdjc400iwp7z4")
 
+# Что подключать при сборке приложения (create_app)
+ADMIN_ROUTES_ENABLED = os.getenv("ADMIN_ROUTES_ENABLED", "1")  # /oauth/status, /bot/*, /debug/*, /chat/*
+AUTO_BOOTSTRAP = os.getenv("AUTO_BOOTSTRAP", "1")  # проверка токена/бота при первом запросе
+
+# Сверка привязок чат↔задача с порталом (закрытые/удалённые задачи)
+RECONCILE_ENABLED = os.getenv("RECONCILE_ENABLED", "1")
+RECONCILE_INTERVAL_SEC = float(os.getenv("RECONCILE_INTERVAL_SEC", "600"))
+RECONCILE_SLICE = int(os.getenv("RECONCILE_SLICE", "200"))  # задач за один прогон
+RECONCILE_POLICY = os.getenv("RECONCILE_POLICY", "unbind").lower()  # unbind | rebind | report
+
+# Адаптивные таймауты: p99 × k в пределах [floor, ceiling]; общий бюджет повторов
+TIMEOUT_P99_MULTIPLIER = float(os.getenv("TIMEOUT_P99_MULTIPLIER", "3"))
+TIMEOUT_FLOOR_SEC = float(os.getenv("TIMEOUT_FLOOR_SEC", "2"))
+TIMEOUT_CEILING_SEC = float(os.getenv("TIMEOUT_CEILING_SEC", "15"))
+TIMEOUT_CONNECT_SEC = float(os.getenv("TIMEOUT_CONNECT_SEC", "3.05"))
+TIMEOUT_MIN_SAMPLES = int(os.getenv("TIMEOUT_MIN_SAMPLES", "20"))  # до этого — прежние фиксированные таймауты
+TIMEOUT_WINDOW = int(os.getenv("TIMEOUT_WINDOW", "200"))  # последних замеров на метод
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "2"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))  # повторов на один обычный запрос
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "10"))
+
+# Приоритетный планировщик перед bitrix_call и Telegram: общий бюджет запросов делится по весам
+SCHED_ENABLED = os.getenv("SCHED_ENABLED", "1")
+SCHED_BITRIX_RATE_PER_SEC = float(os.getenv("SCHED_BITRIX_RATE_PER_SEC", "2"))  # лимит REST Bitrix ~2 rps
+SCHED_BITRIX_BURST = float(os.getenv("SCHED_BITRIX_BURST", "20"))
+SCHED_TELEGRAM_RATE_PER_SEC = float(os.getenv("SCHED_TELEGRAM_RATE_PER_SEC", "25"))  # глобальный лимит ~30 msg/s
+SCHED_TELEGRAM_BURST = float(os.getenv("SCHED_TELEGRAM_BURST", "30"))
+SCHED_WEIGHTS = os.getenv("SCHED_WEIGHTS", "interactive=8,notification=4,bulk=2,admin=1")
+# Сколько каждый класс ждёт слота. Дольше не держим: interactive/notification отправляются без очереди
+# (клиент не должен ждать за рассылкой десятки секунд), bulk/admin получают SCHED_TIMEOUT
+SCHED_MAX_WAIT_SEC = os.getenv("SCHED_MAX_WAIT_SEC", "interactive=1,notification=2,bulk=30,admin=30")
+
+# Offline-события Bitrix (event.offline.get) — опрос вместо push на /bot/events
+BITRIX_OFFLINE_EVENTS = os.getenv("BITRIX_OFFLINE_EVENTS", "0")
+OFFLINE_EVENTS_BATCH = int(os.getenv("OFFLINE_EVENTS_BATCH", "50"))
+OFFLINE_EVENTS_POLL_SEC = float(os.getenv("OFFLINE_EVENTS_POLL_SEC", "5"))
+OFFLINE_EVENTS_ERROR_RETRY_SEC = float(os.getenv("OFFLINE_EVENTS_ERROR_RETRY_SEC", "60"))  # повтор событий с ошибкой
+
+# Локальное состояние с перепиской и токенами — в закрытом каталоге рядом с server.py, а не в общем /tmp
+_STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".state")
+
+# Журнал переписки (SQLite + FTS5) для поиска по истории: /history/search
+JOURNAL_ENABLED = os.getenv("JOURNAL_ENABLED", "1")
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", os.path.join(_STATE_DIR, "bitrix_bridge_journal.sqlite3"))
+JOURNAL_FLUSH_SEC = float(os.getenv("JOURNAL_FLUSH_SEC", "0.5"))
+JOURNAL_BATCH = int(os.getenv("JOURNAL_BATCH", "500"))
+JOURNAL_QUEUE_MAX = int(os.getenv("JOURNAL_QUEUE_MAX", "10000"))
+
+# Запись входящих вебхуков (без секретов) для воспроизведения через replay.py
+CAPTURE_PATH = os.getenv("CAPTURE_PATH")  # например /tmp/capture.jsonl.gz; не задан — запись выключена
+
+# Ранний отсев вебхуков: секреты и лимит запросов с одного IP (до парсинга и логирования)
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")  # передаётся в setWebhook как secret_token
+BITRIX_APPLICATION_TOKEN = os.getenv("BITRIX_APPLICATION_TOKEN")  # auth[application_token] из событий Bitrix
+WEBHOOK_RATE_PER_SEC = float(os.getenv("WEBHOOK_RATE_PER_SEC", "20"))  # Telegram шлёт с немногих IP — лимит щедрый
+WEBHOOK_RATE_BURST = float(os.getenv("WEBHOOK_RATE_BURST", "100"))
+WEBHOOK_MAX_BODY_BYTES = int(os.getenv("WEBHOOK_MAX_BODY_BYTES", str(1024 * 1024)))
+# Сколько доверенных прокси стоит перед приложением (на Render — 1). 0 — X-Forwarded-For игнорируется
+WEBHOOK_TRUSTED_PROXY_HOPS = int(os.getenv("WEBHOOK_TRUSTED_PROXY_HOPS", "0"))
+
+# Трассировка вебхуков (spans для bitrix_call и Telegram), экспорт в OTLP JSON
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1")
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")  # JSON lines, по одному OTLP-объекту на трассу
+TRACE_EXPORT_URL = os.getenv("TRACE_EXPORT_URL")  # например http://127.0.0.1:4318/v1/traces
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "bitrix-bot-bridge")
+
+# Массовая рассылка (/bot/send/bulk)
+BULK_BATCH_SIZE = min(int(os.getenv("BULK_BATCH_SIZE", "50")), 50)  # Bitrix batch: не более 50 команд
+BULK_RATE_PER_SEC = float(os.getenv("BULK_RATE_PER_SEC", "2"))  # batch-вызовов в секунду
+BULK_MAX_WORKERS = int(os.getenv("BULK_MAX_WORKERS", "4"))
+BULK_MAX_JOBS = int(os.getenv("BULK_MAX_JOBS", "50"))  # сколько задач рассылки хранить в памяти
+
+# Тёплый старт: снимок состояния в памяти на локальный диск при остановке
+STATE_SNAPSHOT_ENABLED = os.getenv("STATE_SNAPSHOT_ENABLED", "1")
+# На Render диск сбрасывается при каждом деплое: снимок переживает только перезапуски,
+# если не указать путь на подключённом постоянном диске
+STATE_SNAPSHOT_PATH = os.getenv("STATE_SNAPSHOT_PATH", os.path.join(_STATE_DIR, "bitrix_bot_state.snap"))
+STATE_SNAPSHOT_SECRET = os.getenv("STATE_SNAPSHOT_SECRET")  # если задан — снимок подписывается HMAC-SHA256
+
 # ----------------------
 # Лог всех входящих запросов
 # ----------------------
-@app.before_request
 def log_request_info():
     print("\n--- 📩 Новый запрос ---")
     print(f"⏰ Время: {datetime.now()}")
@@ -50,10 +174,91 @@ def log_request_info():
     print("----------------------\n")
 
 
+# ----------------------
+# Ранний отсев вебхуков: работает первым, до логирования, парсинга и вызовов Bitrix
+# ----------------------
+_GUARDED_ENDPOINTS = {"bridge.telegram_webhook", "bridge.bitrix_events", "bridge.bot_events"}
+_ip_buckets: "OrderedDict[str, _TokenBucket]" = OrderedDict()
+_ip_buckets_lock = threading.Lock()
+_IP_BUCKETS_MAX = 10000
+_guard_stats = {"accepted": 0, "rate_limited": 0, "too_large": 0, "bad_secret": 0}
+
+
+def _client_ip() -> str:
+    if WEBHOOK_TRUSTED_PROXY_HOPS > 0:
+        forwarded = [part.strip() for part in request.headers.get("X-Forwarded-For", "").split(",") if part.strip()]
+        if forwarded:
+            # Каждый прокси дописывает адрес, от которого получил запрос: клиент — N-й с конца,
+            # всё левее мог подставить сам клиент
+            return forwarded[-min(WEBHOOK_TRUSTED_PROXY_HOPS, len(forwarded))]
+    return request.remote_addr or "unknown"
+
+
+def _ip_allowed(ip: str) -> bool:
+    with _ip_buckets_lock:
+        bucket = _ip_buckets.pop(ip, None) or _TokenBucket(WEBHOOK_RATE_PER_SEC, WEBHOOK_RATE_BURST)
+        _ip_buckets[ip] = bucket
+        while len(_ip_buckets) > _IP_BUCKETS_MAX:
+            _ip_buckets.popitem(last=False)
+    return bucket.try_acquire()
+
+
+def _secret_matches(provided: str | None, expected: str) -> bool:
+    return hmac.compare_digest((provided or "").encode("utf-8"), expected.encode("utf-8"))
+
+
+def _bitrix_application_token() -> str | None:
+    token = request.form.get("auth[application_token]")
+    if token is None and request.is_json:
+        auth = (request.get_json(silent=True) or {}).get("auth") or {}
+        token = auth.get("application_token") if isinstance(auth, dict) else None
+    return token
+
+
+def _webhook_guard():
+    if request.method != "POST" or request.endpoint not in _GUARDED_ENDPOINTS:
+        return None
+    if not _ip_allowed(_client_ip()):
+        _guard_stats["rate_limited"] += 1
+        return jsonify({"ok": False, "error": "rate_limited"}), 429
+    if (request.content_length or 0) > WEBHOOK_MAX_BODY_BYTES:
+        _guard_stats["too_large"] += 1
+        return jsonify({"ok": False, "error": "payload_too_large"}), 413
+    if request.endpoint == "bridge.telegram_webhook":
+        if TELEGRAM_WEBHOOK_SECRET and not _secret_matches(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token"), TELEGRAM_WEBHOOK_SECRET
+        ):
+            _guard_stats["bad_secret"] += 1
+            return jsonify({"ok": False, "error": "unauthorized"}), 401
+    elif (
+        request.endpoint == "bridge.bot_events"
+        and BITRIX_APPLICATION_TOKEN
+        and not _secret_matches(_bitrix_application_token(), BITRIX_APPLICATION_TOKEN)
+    ):
+        _guard_stats["bad_secret"] += 1
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    _guard_stats["accepted"] += 1
+    return None
+
+
+@admin.route("/debug/guard", methods=["GET"])
+def debug_guard():
+    return jsonify({
+        "ok": True,
+        "stats": _guard_stats,
+        "tracked_ips": len(_ip_buckets),
+        "telegram_secret_set": bool(TELEGRAM_WEBHOOK_SECRET),
+        "bitrix_application_token_set": bool(BITRIX_APPLICATION_TOKEN),
+        "rate_per_sec": WEBHOOK_RATE_PER_SEC,
+        "burst": WEBHOOK_RATE_BURST,
+        "trusted_proxy_hops": WEBHOOK_TRUSTED_PROXY_HOPS,
+    })
+
+
 # ----------------------
 # Корневой маршрут — POST от Bitrix при установке
 # ----------------------
-@app.route("/", methods=["GET", "POST"])
+@bridge.route("/", methods=["GET", "POST"])
 def root():
     # If Bitrix returned here with OAuth params (code, domain, etc.), forward to the proper callback
     if request.method == "GET" and (request.args.get("code") or request.args.get("DOMAIN") or request.args.get("domain")):
@@ -101,7 +306,7 @@ def root():
 # ----------------------
 # Ручная установка / OAuth-редирект
 # ----------------------
-@app.route("/install", methods=["GET", "POST"])
+@bridge.route("/install", methods=["GET", "POST"])
 def install():
     """
     Bitrix вызывает этот маршрут при установке приложения.
@@ -125,8 +330,8 @@ def install():
         }), 500
 
 # Альтернативный путь для совместимости с документацией
-@app.route("/oauth/install", methods=["GET", "POST"]) 
-@app.route("/oauth/install/", methods=["GET", "POST"]) 
+@bridge.route("/oauth/install", methods=["GET", "POST"]) 
+@bridge.route("/oauth/install/", methods=["GET", "POST"]) 
 def oauth_install():
     """Bitrix calls this path on initial install check. Always return 200 OK."""
     # Optionally log incoming params for troubleshooting
@@ -137,7 +342,7 @@ def oauth_install():
     return jsonify({"ok": True, "message": "Install endpoint is up"})
 
 # Redirect common typo to the correct endpoint
-@app.route("/oauth/introspe", methods=["GET"]) 
+@bridge.route("/oauth/introspe", methods=["GET"]) 
 def oauth_introspe_alias():
     return redirect("/oauth/introspect", code=302)
 
@@ -145,7 +350,7 @@ def oauth_introspe_alias():
 # ----------------------
 # Callback после OAuth
 # ----------------------
-@app.route("/oauth/bitrix/callback", methods=["GET", "POST"])
+@bridge.route("/oauth/bitrix/callback", methods=["GET", "POST"])
 def oauth_callback():
     code = request.args.get("code") or request.form.get("code")
     cb_domain = request.args.get("domain")  # dom.mesopharm.ru
@@ -272,7 +477,7 @@ def _refresh_oauth_token() -> tuple[str | None, str | None, dict | None]:
         "refresh_token": refresh_token,
     }
     try:
-        r = requests.post(portal_token_url, data=payload, timeout=15)
+        r = _http_post("oauth.token", portal_token_url, 15, data=payload)
         if r.status_code == 200:
             result = r.json()
         else:
@@ -281,7 +486,7 @@ def _refresh_oauth_token() -> tuple[str | None, str | None, dict | None]:
         result = None
     if result is None:
         try:
-            r2 = requests.post("https://oauth.bitrix.info/oauth/token/", data=payload, timeout=15)
+            r2 = _http_post("oauth.token", "https://oauth.bitrix.info/oauth/token/", 15, data=payload)
             if r2.status_code == 200:
                 result = r2.json()
         except Exception:
@@ -327,7 +532,21 @@ def load_oauth_tokens():
         return None, None, None
 
 
-def bitrix_call(method: str, payload: dict):
+def bitrix_call(method: str, payload: dict, priority: str | None = None):
+    # Приоритет кладём в контекст — по нему же планировщик выдаёт слоты повторам в _http_post
+    with priority_scope(priority or _current_priority.get()):
+        with trace_span(f"bitrix {method}", kind="client", **{"bitrix.method": method}) as span:
+            if _wait_for_slot(_bitrix_scheduler, None):
+                result, err = _bitrix_call_impl(method, payload)
+            else:
+                result, err = None, dict(_SCHED_TIMEOUT_ERROR)
+            if err:
+                span["status"] = "error"
+                span["status_message"] = str(err.get("error") or err)
+            return result, err
+
+
+def _bitrix_call_impl(method: str, payload: dict):
     # Используем REST API из переменных окружения
     rest_base = BITRIX_REST_API_URL
     url = f"{rest_base}{method}"
@@ -336,7 +555,8 @@ def bitrix_call(method: str, payload: dict):
         params = {}
         if BITRIX_WEBHOOK_TOKEN:
             params["auth"] = BITRIX_WEBHOOK_TOKEN
-        r = requests.post(url, params=params, json=payload, timeout=15)
+        r = _http_post(f"bitrix.{method}", url, 15, _retry_safe(method), params=params, json=payload)
+        trace_set(**{"http.status_code": r.status_code})
         # Try to parse error body even on non-2xx to detect expired_token
         if r.status_code >= 400:
             err_text = r.text or ""
@@ -355,9 +575,11 @@ def bitrix_call(method: str, payload: dict):
                 or "token" in err_descr and "expired" in err_descr
             )
             if token_problem:
+                trace_event("token_refresh", reason=err_code or "expired")
                 new_access, new_rest, _raw = _refresh_oauth_token()
                 if new_access and new_rest:
-                    rr = requests.post(f"{new_rest}{method}", params={"auth": new_access}, json=payload, timeout=15)
+                    rr = _http_post(f"bitrix.{method}", f"{new_rest}{method}", 15, _retry_safe(method), params={"auth": new_access}, json=payload)
+                    trace_event("retry", **{"http.status_code": rr.status_code})
                     if rr.status_code >= 400:
                         try:
                             return None, rr.json()
@@ -383,9 +605,11 @@ def bitrix_call(method: str, payload: dict):
             # Secondary JSON error handling
             err_descr2 = (data.get("error_description") or "").lower()
             if data.get("error") in {"expired_token", "invalid_token", "NO_AUTH_FOUND", "INVALID_TOKEN"} or ("access token" in err_descr2 and "expire" in err_descr2):
+                trace_event("token_refresh", reason=data.get("error"))
                 new_access, new_rest, _raw = _refresh_oauth_token()
                 if new_access and new_rest:
-                    rr = requests.post(f"{new_rest}{method}", params={"auth": new_access}, json=payload, timeout=15)
+                    rr = _http_post(f"bitrix.{method}", f"{new_rest}{method}", 15, _retry_safe(method), params={"auth": new_access}, json=payload)
+                    trace_event("retry", **{"http.status_code": rr.status_code})
                     if rr.status_code >= 400:
                         try:
                             return None, rr.json()
@@ -404,6 +628,641 @@ def bitrix_call(method: str, payload: dict):
         return None, {"error": "request_failed", "error_description": str(e)}
 
 
+def _bitrix_query(params: dict, prefix: str = "") -> list[tuple[str, str]]:
+    # Разворачиваем вложенные dict/list в пары PHP-стиля (filter[ID][0]=1) для команд batch
+    pairs: list[tuple[str, str]] = []
+    for key, value in params.items():
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, dict):
+            pairs.extend(_bitrix_query(value, name))
+        elif isinstance(value, (list, tuple)):
+            pairs.extend(_bitrix_query(dict(enumerate(value)), name))
+        elif value is not None:
+            pairs.append((name, str(value)))
+    return pairs
+
+
+def bitrix_batch_command(method: str, params: dict) -> str:
+    return f"{method}?{urlencode(_bitrix_query(params))}"
+
+
+# ----------------------
+# Ограничение скорости (token bucket)
+# ----------------------
+
+class _TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = max(rate, 0.001)
+        self.capacity = capacity if capacity is not None else max(self.rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1.0):
+        # Блокирующее ожидание токена — только для фоновых задач, не для вебхуков
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# ----------------------
+# Адаптивные таймауты по методам и общий бюджет повторов
+# ----------------------
+
+class _LatencyTracker:
+    def __init__(self, window: int):
+        self.window = window
+        self._samples: dict[str, deque] = {}
+        self._counters: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def _counter(self, key: str) -> dict:
+        return self._counters.setdefault(key, {"calls": 0, "errors": 0, "timeouts": 0, "retries": 0})
+
+    def record(self, key: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+            self._counter(key)["calls"] += 1
+
+    def record_timeout(self, key: str, timeout: float):
+        # Ответа не дождались: задержка не меньше таймаута — учитываем её как замер,
+        # иначе после серии быстрых ответов таймаут прижат к порогу и уже не растёт
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window)).append(timeout)
+
+    def count(self, key: str, field: str):
+        with self._lock:
+            self._counter(key)[field] += 1
+
+    def percentiles(self, key: str) -> dict:
+        with self._lock:
+            samples = sorted(self._samples.get(key) or ())
+        if not samples:
+            return {"samples": 0}
+
+        def pct(p: float) -> float:
+            return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+        return {"samples": len(samples), "p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99)}
+
+    def timeout_for(self, key: str, default: float) -> float:
+        stats = self.percentiles(key)
+        if stats["samples"] < TIMEOUT_MIN_SAMPLES:
+            return default
+        return min(TIMEOUT_CEILING_SEC, max(TIMEOUT_FLOOR_SEC, stats["p99"] * TIMEOUT_P99_MULTIPLIER))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            keys = sorted(set(self._samples) | set(self._counters))
+            counters = {k: dict(self._counters.get(k) or {}) for k in keys}
+        return {k: {**self.percentiles(k), **counters[k]} for k in keys}
+
+
+class _RetryBudget:
+    # Каждый обычный запрос пополняет бюджет на RETRY_BUDGET_RATIO, каждый повтор тратит 1:
+    # при массовых сбоях доля повторов не превышает ~10% и не умножает нагрузку на портал
+    def __init__(self, ratio: float, maximum: float):
+        self.ratio = ratio
+        self.maximum = maximum
+        self._tokens = maximum
+        self._lock = threading.Lock()
+        self.denied = 0
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.maximum, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.denied += 1
+            return False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"tokens": round(self._tokens, 2), "ratio": self.ratio, "max": self.maximum, "denied": self.denied}
+
+
+_latency = _LatencyTracker(TIMEOUT_WINDOW)
+_retry_budget = _RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX)
+_default_timeouts: dict[str, float] = {}
+# Явный список чистых чтений. Не по суффиксу: event.offline.get с clear=0 закрепляет события
+# за process_id, и повтор после потерянного ответа оставил бы первую пачку недоступной
+_RETRY_SAFE_METHODS = {
+    "app.info", "imbot.bot.list", "tasks.task.list", "tasks.task.get", "user.current", "profile",
+    "getMe", "getWebhookInfo",
+}
+
+
+def _retry_safe(method: str) -> bool:
+    # Повтор после отправленного запроса допустим только для чтения; иначе — лишь при сбое соединения
+    return method in _RETRY_SAFE_METHODS
+
+
+def _request_not_sent(e: Exception) -> bool:
+    # Соединение не установлено — запрос до сервера не дошёл, повтор безопасен для любого метода
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return type(reason).__name__ in {"NewConnectionError", "NameResolutionError"}
+
+
+def _http_post(key: str, url: str, default_timeout: float, retry_safe: bool = False, **kwargs):
+    _default_timeouts.setdefault(key, default_timeout)
+    _retry_budget.deposit()
+    attempt = 0
+    while True:
+        attempt += 1
+        timeout = _latency.timeout_for(key, default_timeout)
+        started = time.perf_counter()
+        try:
+            r = requests.post(url, timeout=(min(TIMEOUT_CONNECT_SEC, timeout), timeout), **kwargs)
+        except requests.exceptions.RequestException as e:
+            is_timeout = isinstance(e, requests.exceptions.Timeout)
+            _latency.count(key, "timeouts" if is_timeout else "errors")
+            if isinstance(e, requests.exceptions.ReadTimeout):
+                _latency.record_timeout(key, timeout)
+            if (
+                attempt < RETRY_MAX_ATTEMPTS
+                and (retry_safe or _request_not_sent(e))
+                and _retry_budget.withdraw()
+                and _wait_for_slot(_scheduler_for(key), None)  # повтор — такой же вызов, платит токеном
+            ):
+                _latency.count(key, "retries")
+                trace_event("retry", reason=type(e).__name__, attempt=attempt, timeout_sec=round(timeout, 2))
+                time.sleep(random.uniform(0, 0.2 * attempt))
+                continue
+            raise
+        _latency.record(key, time.perf_counter() - started)
+        if (
+            (r.status_code >= 500 or r.status_code == 429)
+            and retry_safe
+            and attempt < RETRY_MAX_ATTEMPTS
+            and _retry_budget.withdraw()
+            and _wait_for_slot(_scheduler_for(key), None)
+        ):
+            _latency.count(key, "retries")
+            trace_event("retry", reason=f"HTTP_{r.status_code}", attempt=attempt)
+            time.sleep(random.uniform(0.1, 0.3 * attempt))
+            continue
+        return r
+
+
+@admin.route("/debug/timeouts", methods=["GET"])
+def debug_timeouts():
+    policies = {}
+    for key, stats in _latency.snapshot().items():
+        default = _default_timeouts.get(key, TIMEOUT_CEILING_SEC)
+        policies[key] = {
+            **{k: (round(v * 1000, 1) if k in {"p50", "p90", "p99"} else v) for k, v in stats.items()},
+            "timeout_sec": round(_latency.timeout_for(key, default), 3),
+            "adaptive": stats.get("samples", 0) >= TIMEOUT_MIN_SAMPLES,
+            "retry_safe": _retry_safe(key.split(".", 1)[-1]),
+        }
+    return jsonify({
+        "ok": True,
+        "latency_unit": "ms",
+        "multiplier": TIMEOUT_P99_MULTIPLIER,
+        "floor_sec": TIMEOUT_FLOOR_SEC,
+        "ceiling_sec": TIMEOUT_CEILING_SEC,
+        "max_attempts": RETRY_MAX_ATTEMPTS,
+        "retry_budget": _retry_budget.snapshot(),
+        "policies": policies,
+    })
+
+
+# ----------------------
+# Приоритетный планировщик: interactive > notification > bulk > admin
+# ----------------------
+PRIORITIES = ("interactive", "notification", "bulk", "admin")
+_current_priority: ContextVar[str] = ContextVar("current_priority", default="admin")
+
+
+def _parse_per_class(spec: str, defaults: dict[str, float], minimum: float) -> dict[str, float]:
+    # "interactive=8,bulk=2" — неуказанные классы берут значения по умолчанию
+    values = dict(defaults)
+    for part in (spec or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() in values:
+            try:
+                values[name.strip()] = max(float(value), minimum)
+            except ValueError:
+                pass
+    return values
+
+
+def _parse_weights(spec: str) -> dict[str, float]:
+    return _parse_per_class(spec, {"interactive": 8.0, "notification": 4.0, "bulk": 2.0, "admin": 1.0}, 0.01)
+
+
+def _parse_max_waits(spec: str) -> dict[str, float]:
+    try:
+        # Прежний формат — одно число на все классы
+        return {p: max(float(spec), 0.0) for p in PRIORITIES}
+    except ValueError:
+        pass
+    return _parse_per_class(spec, {"interactive": 1.0, "notification": 2.0, "bulk": 30.0, "admin": 30.0}, 0.0)
+
+
+class _PriorityScheduler:
+    # Token bucket + stride scheduling между классами; interactive вытесняет остальных
+    def __init__(self, name: str, rate: float, burst: float, weights: dict[str, float], max_waits: dict[str, float]):
+        self.name = name
+        self.rate = max(rate, 0.001)
+        self.capacity = max(burst, 1.0)
+        self.weights = weights
+        self.max_waits = max_waits
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiting: dict[str, deque] = {p: deque() for p in PRIORITIES}
+        self._pass = {p: 0.0 for p in PRIORITIES}
+        self._vtime = 0.0
+        self.stats = {p: {"granted": 0, "timeouts": 0, "wait_ms_total": 0.0, "max_wait_ms": 0.0} for p in PRIORITIES}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _pick(self) -> str | None:
+        if self._waiting["interactive"]:
+            return "interactive"
+        active = [p for p in PRIORITIES if self._waiting[p]]
+        return min(active, key=lambda p: self._pass[p]) if active else None
+
+    def acquire(self, priority: str) -> bool:
+        if priority not in self._waiting:
+            priority = "admin"
+        ticket = object()
+        started = time.monotonic()
+        deadline = started + self.max_waits[priority]
+        with self._cond:
+            if not self._waiting[priority]:
+                # Класс простаивал — не даём ему «накопить» долю за время простоя
+                self._pass[priority] = max(self._pass[priority], self._vtime)
+            self._waiting[priority].append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._tokens >= 1 and self._pick() == priority and self._waiting[priority][0] is ticket:
+                        self._tokens -= 1
+                        self._vtime = self._pass[priority]
+                        self._pass[priority] += 1.0 / self.weights[priority]
+                        granted = True
+                        break
+                    if now >= deadline:
+                        granted = False
+                        break
+                    if self._tokens >= 1:
+                        # Токен есть, но очередь не наша — будим того, чья очередь
+                        self._cond.notify_all()
+                        wait = 0.05
+                    else:
+                        wait = (1 - self._tokens) / self.rate
+                    self._cond.wait(timeout=min(max(wait, 0.001), deadline - now))
+            finally:
+                self._waiting[priority].remove(ticket)
+                self._cond.notify_all()
+            waited_ms = (time.monotonic() - started) * 1000
+            st = self.stats[priority]
+            st["granted" if granted else "timeouts"] += 1
+            st["wait_ms_total"] += waited_ms
+            st["max_wait_ms"] = max(st["max_wait_ms"], waited_ms)
+        return granted
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                "rate_per_sec": self.rate,
+                "burst": self.capacity,
+                "tokens": round(self._tokens, 2),
+                "weights": self.weights,
+                "max_wait_sec": self.max_waits,
+                "waiting": {p: len(q) for p, q in self._waiting.items()},
+                "stats": {
+                    p: {**st, "avg_wait_ms": round(st["wait_ms_total"] / max(st["granted"] + st["timeouts"], 1), 2)}
+                    for p, st in self.stats.items()
+                },
+            }
+
+
+_bitrix_scheduler = _PriorityScheduler(
+    "bitrix", SCHED_BITRIX_RATE_PER_SEC, SCHED_BITRIX_BURST, _parse_weights(SCHED_WEIGHTS), _parse_max_waits(SCHED_MAX_WAIT_SEC),
+)
+_telegram_scheduler = _PriorityScheduler(
+    "telegram", SCHED_TELEGRAM_RATE_PER_SEC, SCHED_TELEGRAM_BURST, _parse_weights(SCHED_WEIGHTS), _parse_max_waits(SCHED_MAX_WAIT_SEC),
+)
+
+
+@contextmanager
+def priority_scope(priority: str):
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+# Классы, которые при истечении своего SCHED_MAX_WAIT_SEC не отправляются без токена, а получают ошибку
+_SCHED_FAIL_ON_TIMEOUT = {"bulk", "admin"}
+_SCHED_TIMEOUT_ERROR = {"error": "SCHED_TIMEOUT", "error_description": "no rate-limit slot within SCHED_MAX_WAIT_SEC"}
+
+
+def _wait_for_slot(scheduler: _PriorityScheduler | None, priority: str | None) -> bool:
+    # False — слот не получен и вызов отправлять нельзя
+    if scheduler is None or not _enabled(SCHED_ENABLED):
+        return True
+    priority = priority or _current_priority.get()
+    started = time.perf_counter()
+    granted = scheduler.acquire(priority)
+    waited_ms = round((time.perf_counter() - started) * 1000, 2)
+    trace_set(**{"sched.priority": priority, "sched.wait_ms": waited_ms})
+    if granted:
+        return True
+    if priority in _SCHED_FAIL_ON_TIMEOUT:
+        print(f"⚠️ Планировщик {scheduler.name}: {priority} ждал {round(waited_ms)} мс, вызов отклонён")
+        return False
+    print(f"⚠️ Планировщик {scheduler.name}: {priority} ждал {round(waited_ms)} мс, отправляем без очереди")
+    return True
+
+
+def _scheduler_for(key: str) -> _PriorityScheduler | None:
+    # Ключ _http_post вида "bitrix.<method>" / "telegram.<method>"; oauth.* не ограничиваем
+    return {"bitrix": _bitrix_scheduler, "telegram": _telegram_scheduler}.get(key.split(".", 1)[0])
+
+
+_ENDPOINT_PRIORITIES = {
+    "bridge.telegram_webhook": "interactive",
+    "bridge.bitrix_events": "notification",
+    "bridge.bot_events": "notification",
+}
+
+
+def _assign_request_priority():
+    priority = _ENDPOINT_PRIORITIES.get(request.endpoint or "")
+    if priority is None:
+        priority = "admin" if (request.blueprint == "admin") else "interactive"
+    request.environ["bridge.priority_token"] = _current_priority.set(priority)
+
+
+def _reset_request_priority(exc=None):
+    token = request.environ.pop("bridge.priority_token", None)
+    if token is not None:
+        _current_priority.reset(token)
+
+
+@admin.route("/debug/scheduler", methods=["GET"])
+def debug_scheduler():
+    return jsonify({
+        "ok": True,
+        "enabled": _enabled(SCHED_ENABLED),
+        "bitrix": _bitrix_scheduler.snapshot(),
+        "telegram": _telegram_scheduler.snapshot(),
+    })
+
+
+# ----------------------
+# Трассировка: trace_id на входящий вебхук, span на каждый вызов Bitrix/Telegram
+# ----------------------
+_current_trace: ContextVar[dict | None] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[dict | None] = ContextVar("current_span", default=None)
+_recent_traces: deque = deque(maxlen=TRACE_BUFFER_SIZE)
+_recent_traces_lock = threading.Lock()
+_trace_export_queue: "queue.Queue[dict]" = queue.Queue(maxsize=1000)
+_trace_exporter_started = False
+_TRACED_ENDPOINTS = {"bridge.telegram_webhook", "bridge.bitrix_events", "bridge.bot_events"}
+
+
+def _new_span(name: str, kind: str, parent: dict | None, attributes: dict) -> dict:
+    return {
+        "span_id": f"{random.getrandbits(64):016x}",
+        "parent_span_id": parent["span_id"] if parent else None,
+        "name": name,
+        "kind": kind,
+        "start_ns": time.time_ns(),
+        "end_ns": None,
+        "attributes": dict(attributes),
+        "events": [],
+        "status": "ok",
+        "status_message": None,
+    }
+
+
+@contextmanager
+def trace_span(name: str, kind: str = "internal", **attributes):
+    trace = _current_trace.get()
+    if trace is None:
+        # Вне трассируемого запроса (фоновые задачи) — span никуда не пишется
+        yield {"attributes": {}, "events": []}
+        return
+    span = _new_span(name, kind, _current_span.get(), attributes)
+    trace["spans"].append(span)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span["status"] = "error"
+        span["status_message"] = str(e)
+        raise
+    finally:
+        span["end_ns"] = time.time_ns()
+        _current_span.reset(token)
+
+
+def trace_set(**attributes):
+    span = _current_span.get()
+    if span is not None:
+        span["attributes"].update(attributes)
+
+
+def trace_event(name: str, **attributes):
+    span = _current_span.get()
+    if span is not None:
+        span["events"].append({"name": name, "time_ns": time.time_ns(), "attributes": attributes})
+
+
+def _trace_begin_request():
+    if not _enabled(TRACE_ENABLED) or request.method != "POST" or request.endpoint not in _TRACED_ENDPOINTS:
+        return
+    trace = {"trace_id": f"{random.getrandbits(128):032x}", "spans": []}
+    root = _new_span(f"{request.method} {request.path}", "server", None, {
+        "http.method": request.method,
+        "http.route": request.path,
+    })
+    trace["spans"].append(root)
+    request.environ["bridge.trace_tokens"] = (_current_trace.set(trace), _current_span.set(root))
+
+
+def _trace_record_response(response):
+    trace = _current_trace.get()
+    if trace is not None:
+        root = trace["spans"][0]
+        root["attributes"]["http.status_code"] = response.status_code
+        if response.status_code >= 500:
+            root["status"] = "error"
+        response.headers["X-Trace-Id"] = trace["trace_id"]
+    return response
+
+
+def _trace_end_request(exc=None):
+    tokens = request.environ.pop("bridge.trace_tokens", None)
+    trace = _current_trace.get()
+    if tokens is None or trace is None:
+        return
+    root = trace["spans"][0]
+    root["end_ns"] = time.time_ns()
+    if exc is not None:
+        root["status"] = "error"
+        root["status_message"] = str(exc)
+    _current_span.reset(tokens[1])
+    _current_trace.reset(tokens[0])
+    trace["duration_ms"] = round((root["end_ns"] - root["start_ns"]) / 1e6, 2)
+    with _recent_traces_lock:
+        _recent_traces.append(trace)
+    if TRACE_EXPORT_FILE or TRACE_EXPORT_URL:
+        _start_trace_exporter()
+        try:
+            _trace_export_queue.put_nowait(trace)
+        except queue.Full:
+            print("⚠️ Очередь экспорта трасс переполнена, трасса пропущена")
+
+
+def _otlp_attributes(attributes: dict) -> list[dict]:
+    out = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            out.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            out.append({"key": key, "value": {"intValue": str(value)}})
+        elif isinstance(value, float):
+            out.append({"key": key, "value": {"doubleValue": value}})
+        else:
+            out.append({"key": key, "value": {"stringValue": str(value)}})
+    return out
+
+
+_OTLP_SPAN_KIND = {"internal": 1, "server": 2, "client": 3}
+
+
+def traces_to_otlp(traces: list[dict]) -> dict:
+    spans = []
+    for trace in traces:
+        for span in trace["spans"]:
+            otlp_span = {
+                "traceId": trace["trace_id"],
+                "spanId": span["span_id"],
+                "name": span["name"],
+                "kind": _OTLP_SPAN_KIND.get(span["kind"], 1),
+                "startTimeUnixNano": str(span["start_ns"]),
+                "endTimeUnixNano": str(span["end_ns"] or span["start_ns"]),
+                "attributes": _otlp_attributes(span["attributes"]),
+                "events": [
+                    {"timeUnixNano": str(e["time_ns"]), "name": e["name"], "attributes": _otlp_attributes(e["attributes"])}
+                    for e in span["events"]
+                ],
+                "status": {"code": 2 if span["status"] == "error" else 1, "message": span["status_message"] or ""},
+            }
+            if span["parent_span_id"]:
+                otlp_span["parentSpanId"] = span["parent_span_id"]
+            spans.append(otlp_span)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": TRACE_SERVICE_NAME})},
+            "scopeSpans": [{"scope": {"name": "bitrix_bot_bridge"}, "spans": spans}],
+        }]
+    }
+
+
+def _trace_export_loop():
+    while True:
+        batch = [_trace_export_queue.get()]
+        # Забираем всё, что накопилось, и отправляем одной пачкой
+        while len(batch) < 100:
+            try:
+                batch.append(_trace_export_queue.get_nowait())
+            except queue.Empty:
+                break
+        payload = traces_to_otlp(batch)
+        if TRACE_EXPORT_FILE:
+            try:
+                with open(TRACE_EXPORT_FILE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+            except Exception as e:
+                print("⚠️ Ошибка записи трасс в файл:", e)
+        if TRACE_EXPORT_URL:
+            try:
+                requests.post(TRACE_EXPORT_URL, json=payload, timeout=5)
+            except Exception as e:
+                print("⚠️ Ошибка отправки трасс в коллектор:", e)
+
+
+def _start_trace_exporter():
+    global _trace_exporter_started
+    with _recent_traces_lock:
+        if _trace_exporter_started:
+            return
+        _trace_exporter_started = True
+    threading.Thread(target=_trace_export_loop, daemon=True).start()
+
+
+def _trace_summary(trace: dict) -> dict:
+    root = trace["spans"][0]
+    return {
+        "trace_id": trace["trace_id"],
+        "name": root["name"],
+        "started_at": datetime.fromtimestamp(root["start_ns"] / 1e9).isoformat(),
+        "duration_ms": trace.get("duration_ms"),
+        "status": root["status"],
+        "spans": [
+            {
+                "name": s["name"],
+                "offset_ms": round((s["start_ns"] - root["start_ns"]) / 1e6, 2),
+                "duration_ms": round(((s["end_ns"] or s["start_ns"]) - s["start_ns"]) / 1e6, 2),
+                "status": s["status"],
+                "status_message": s["status_message"],
+                "attributes": s["attributes"],
+                "events": [e["name"] for e in s["events"]],
+            }
+            for s in trace["spans"][1:]
+        ],
+    }
+
+
+@admin.route("/debug/traces", methods=["GET"])
+def debug_traces():
+    try:
+        limit = max(1, min(int(request.args.get("limit", "20")), TRACE_BUFFER_SIZE))
+    except ValueError:
+        return jsonify({"ok": False, "error": "limit must be an integer"}), 400
+    with _recent_traces_lock:
+        traces = list(_recent_traces)
+    slowest = sorted(traces, key=lambda t: t.get("duration_ms") or 0, reverse=True)[:limit]
+    if request.args.get("format") == "otlp":
+        return jsonify(traces_to_otlp(slowest))
+    return jsonify({"ok": True, "buffered": len(traces), "traces": [_trace_summary(t) for t in slowest]})
+
+
 # ----------------------
 # Регистрация бота (helper)
 # ----------------------
@@ -419,7 +1278,7 @@ def register_bot() -> str | None:
 # ----------------------
 # Статус OAuth: есть ли токен и какой домен
 # ----------------------
-@app.route("/oauth/status", methods=["GET"])
+@admin.route("/oauth/status", methods=["GET"])
 def oauth_status():
     access_token, rest_base, raw = load_oauth_tokens()
     source = "memory" if _memory_token_cache.get("access_token") else ("env" if os.getenv("BITRIX_ACCESS_TOKEN") else "none")
@@ -435,7 +1294,7 @@ def oauth_status():
 
 
 # Безопасный дебаг, чтобы убедиться в корректных настройках (без секретов)
-@app.route("/oauth/debug", methods=["GET"])
+@admin.route("/oauth/debug", methods=["GET"])
 def oauth_debug():
     return jsonify({
         "bitrix_domain": BITRIX_DOMAIN,
@@ -444,7 +1303,7 @@ def oauth_debug():
         "has_client_secret": bool(CLIENT_SECRET),
     })
 
-@app.route("/oauth/token", methods=["GET"]) 
+@admin.route("/oauth/token", methods=["GET"]) 
 def oauth_token_view():
     """Show masked access token. Pass full=1 to return full token (use cautiously)."""
     token = _memory_token_cache.get("access_token") or os.getenv("BITRIX_ACCESS_TOKEN")
@@ -454,7 +1313,7 @@ def oauth_token_view():
     masked = token if show_full else (token[:6] + "..." + token[-6:])
     return jsonify({"has_access_token": True, "access_token": masked, "full": show_full})
 
-@app.route("/oauth/refresh_token", methods=["GET"]) 
+@admin.route("/oauth/refresh_token", methods=["GET"]) 
 def oauth_refresh_token_view():
     """Show masked refresh token. Pass full=1 to return full token (use cautiously)."""
     raw = _memory_token_cache.get("raw") or {}
@@ -465,7 +1324,7 @@ def oauth_refresh_token_view():
     masked = token if show_full else (token[:6] + "..." + token[-6:])
     return jsonify({"has_refresh_token": True, "refresh_token": masked, "full": show_full})
 
-@app.route("/oauth/introspect", methods=["GET"]) 
+@admin.route("/oauth/introspect", methods=["GET"]) 
 def oauth_introspect():
     """Call app.info with current token to verify validity and scopes (without showing the token)."""
     token = _memory_token_cache.get("access_token") or os.getenv("BITRIX_ACCESS_TOKEN")
@@ -491,10 +1350,170 @@ def oauth_introspect():
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
+# ----------------------
+# Telegram Bot API (helper) и подтверждения входящих сообщений
+# ----------------------
+
+def telegram_api(method: str, payload: dict, priority: str | None = None):
+    with priority_scope(priority or _current_priority.get()):
+        with trace_span(f"telegram {method}", kind="client", **{"telegram.method": method}) as span:
+            if _wait_for_slot(_telegram_scheduler, None):
+                result, err = _telegram_api_impl(method, payload)
+            else:
+                result, err = None, dict(_SCHED_TIMEOUT_ERROR)
+            if err:
+                span["status"] = "error"
+                span["status_message"] = str(err.get("error_description") or err.get("error"))
+            return result, err
+
+
+def _telegram_api_impl(method: str, payload: dict):
+    try:
+        r = _http_post(
+            f"telegram.{method}",
+            f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}/{method}",
+            10,
+            _retry_safe(method),
+            json=payload,
+        )
+        trace_set(**{"http.status_code": r.status_code})
+        try:
+            data = r.json()
+        except Exception:
+            data = {"ok": False, "description": r.text}
+        if not r.ok or not data.get("ok"):
+            return None, {"error": f"HTTP_{r.status_code}", "error_description": data.get("description") or r.text}
+        return data.get("result"), None
+    except Exception as e:
+        return None, {"error": "request_failed", "error_description": str(e)}
+
+
+def _tg_ack_entry(chat_key: str) -> dict:
+    # Небольшой LRU-кэш состояния подтверждений на чат (вызывать под _tg_ack_lock)
+    entry = _tg_ack_cache.pop(chat_key, None) or {
+        "message_id": None,
+        "last_sent": 0.0,
+        "suppressed": 0,
+        "acks": 0,
+        "pending_text": None,
+        "timer": None,
+        "lock": threading.Lock(),
+    }
+    _tg_ack_cache[chat_key] = entry
+    while len(_tg_ack_cache) > TELEGRAM_ACK_CACHE_SIZE:
+        _tg_ack_cache.popitem(last=False)
+    return entry
+
+
+def _tg_ack_send_status(chat_id, entry: dict, text: str):
+    sent, err = telegram_api("sendMessage", {"chat_id": chat_id, "text": text, "disable_notification": True})
+    if err:
+        print("⚠️ Ошибка отправки сообщения в Telegram:", err)
+        return
+    entry["message_id"] = (sent or {}).get("message_id")
+    if TELEGRAM_ACK_PIN in {"1", "true", "TRUE", "yes", "on"} and entry["message_id"]:
+        _res, pin_err = telegram_api("pinChatMessage", {
+            "chat_id": chat_id,
+            "message_id": entry["message_id"],
+            "disable_notification": True,
+        })
+        if pin_err:
+            print("⚠️ Не удалось закрепить статусное сообщение:", pin_err)
+
+
+def _telegram_ack(chat_id, inbound_message_id, reply_text: str, is_error: bool = False):
+    mode = TELEGRAM_ACK_MODE
+    if mode == "message" or mode not in {"edit", "reaction", "debounce"}:
+        _res, err = telegram_api("sendMessage", {"chat_id": chat_id, "text": reply_text})
+        if err:
+            print("⚠️ Ошибка отправки сообщения в Telegram:", err)
+        return
+
+    # Ошибки всегда отправляем отдельным сообщением в любом режиме — их нельзя терять
+    if is_error:
+        _res, err = telegram_api("sendMessage", {"chat_id": chat_id, "text": reply_text})
+        if err:
+            print("⚠️ Ошибка отправки сообщения в Telegram:", err)
+        return
+
+    with _tg_ack_lock:
+        entry = _tg_ack_entry(str(chat_id))
+    # Сетевые вызовы — под блокировкой только этого чата, чтобы не тормозить остальные
+    with entry["lock"]:
+        now = time.monotonic()
+
+        if mode == "edit":
+            # Одно статусное сообщение на чат. Счётчик в тексте — Telegram отклоняет правку без изменений,
+            # а по одному времени два сообщения за секунду дали бы одинаковый текст
+            entry["acks"] += 1
+            status_text = f"{reply_text}\n🕒 {datetime.now().strftime('%H:%M:%S')} · №{entry['acks']}"
+            if entry["message_id"]:
+                _res, err = telegram_api("editMessageText", {
+                    "chat_id": chat_id,
+                    "message_id": entry["message_id"],
+                    "text": status_text,
+                })
+                if not err or "message is not modified" in str(err.get("error_description", "")):
+                    entry["last_sent"] = now
+                    return
+                print("ℹ️ Не удалось изменить статусное сообщение, отправляем новое:", err)
+            _tg_ack_send_status(chat_id, entry, status_text)
+            entry["last_sent"] = now
+            return
+
+        if mode == "reaction" and inbound_message_id:
+            _res, err = telegram_api("setMessageReaction", {
+                "chat_id": chat_id,
+                "message_id": inbound_message_id,
+                "reaction": [{"type": "emoji", "emoji": TELEGRAM_ACK_REACTION}],
+            })
+            if not err:
+                entry["last_sent"] = now
+                return
+            print("ℹ️ Реакция не поставлена, отправляем сообщение:", err)
+        elif mode == "debounce" and now - entry["last_sent"] < TELEGRAM_ACK_DEBOUNCE_SEC:
+            # Внутри окна молчим, но по его окончании подтверждаем последнее сообщение
+            entry["suppressed"] += 1
+            entry["pending_text"] = reply_text
+            if entry.get("timer") is None:
+                delay = max(0.0, entry["last_sent"] + TELEGRAM_ACK_DEBOUNCE_SEC - now)
+                timer = threading.Timer(delay, _tg_ack_flush_debounced, args=(chat_id, entry))
+                timer.daemon = True
+                entry["timer"] = timer
+                timer.start()
+            return
+
+        _tg_ack_send_collapsed(chat_id, entry, reply_text, now)
+
+
+def _tg_ack_send_collapsed(chat_id, entry: dict, reply_text: str, now: float):
+    # Вызывать под entry["lock"]
+    if entry["suppressed"]:
+        reply_text = f"{reply_text}\n(и ещё сообщений: {entry['suppressed']})"
+    _res, err = telegram_api("sendMessage", {"chat_id": chat_id, "text": reply_text})
+    if err:
+        print("⚠️ Ошибка отправки сообщения в Telegram:", err)
+        return
+    entry["last_sent"] = now
+    entry["suppressed"] = 0
+    entry["pending_text"] = None
+
+
+def _tg_ack_flush_debounced(chat_id, entry: dict):
+    # Хвостовое подтверждение режима debounce: окно закрылось, а сообщения в нём остались без ответа
+    with priority_scope("notification"), entry["lock"]:
+        entry["timer"] = None
+        if not entry["suppressed"] or not entry.get("pending_text"):
+            return
+        # Последнее сообщение само подтверждается текстом, в счётчик «ещё» не входит
+        entry["suppressed"] -= 1
+        _tg_ack_send_collapsed(chat_id, entry, entry["pending_text"], time.monotonic())
+
+
 # ----------------------
 # Telegram webhook: принимает сообщения и создаёт/комментирует задачу в Bitrix
 # ----------------------
-@app.route("/telegram/webhook", methods=["GET", "POST"]) 
+@bridge.route("/telegram/webhook", methods=["GET", "POST"]) 
 def telegram_webhook():
     # GET — healthcheck/webhook verification convenience
     if request.method == "GET":
@@ -512,7 +1531,7 @@ def telegram_webhook():
     description = f"Источник: Telegram chat_id={chat_id}\n\nТекст: {text}"
 
     # Фиксированный ответственный (Бот Техподдержки)
-    responsible_id = 19508
+    responsible_id = TASK_RESPONSIBLE_ID
 
     # Если уже есть связанная задача для этого чата — добавляем комментарий
     existing_task_id = _chat_to_task_map.get(str(chat_id))
@@ -532,6 +1551,12 @@ def telegram_webhook():
             })
         task_id = existing_task_id
     else:
+        # Чат отвязан сверкой от закрытой задачи (RECONCILE_POLICY=rebind) — новая задача её продолжает
+        with _mapping_lock:
+            predecessor = _chat_predecessor.get(str(chat_id))
+        if predecessor:
+            title = f"Продолжение обращения из Telegram (задача #{predecessor} закрыта)"
+            description = f"{description}\n\nПредыдущая задача: #{predecessor}"
         # Создаём новую задачу
         result, err = bitrix_call("tasks.task.add", {
             "fields": {
@@ -546,8 +1571,19 @@ def telegram_webhook():
     if not err and not existing_task_id:
         task_id = (result or {}).get("task", {}).get("id") if isinstance(result, dict) else result
         if task_id:
-            _task_to_chat_map[str(task_id)] = str(chat_id)
-            _chat_to_task_map[str(chat_id)] = str(task_id)
+            with _mapping_lock:
+                _task_to_chat_map[str(task_id)] = str(chat_id)
+                _chat_to_task_map[str(chat_id)] = str(task_id)
+                _chat_predecessor.pop(str(chat_id), None)
+
+    journal_record(
+        "in", "telegram", "telegram_webhook",
+        chat_id=chat_id,
+        task_id=task_id,
+        author=(message.get("from") or {}).get("username") or (message.get("from") or {}).get("id"),
+        text=text,
+        status="error" if err else "ok",
+    )
 
     if TELEGRAM_BOT_TOKEN:
         reply_text = ""
@@ -558,14 +1594,8 @@ def telegram_webhook():
                 reply_text = f"Комментарий добавлен в задачу: {task_id}"
             else:
                 reply_text = f"Задача создана: {task_id}"
-        try:
-            requests.post(
-                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                json={"chat_id": chat_id, "text": reply_text},
-                timeout=10,
-            )
-        except Exception as e:
-            print("⚠️ Ошибка отправки сообщения в Telegram:", e)
+        _telegram_ack(chat_id, message.get("message_id"), reply_text, is_error=bool(err))
+        journal_record("out", "telegram", "telegram_webhook", chat_id=chat_id, task_id=task_id, text=reply_text)
 
     # Дополнительно: пересылаем текст из Telegram в Bitrix IM (двусторонний мост)
     try:
@@ -583,6 +1613,13 @@ def telegram_webhook():
             _res, _err = bitrix_call("imbot.message.add", payload)
             if _err:
                 print("⚠️ Ошибка пересылки в Bitrix IM:", _err)
+            journal_record(
+                "out", "bitrix_im", "telegram_webhook",
+                chat_id=chat_id,
+                dialog_id=target_dialog,
+                text=text,
+                status="error" if _err else "ok",
+            )
     except Exception as e:
         print("⚠️ Исключение при пересылке в Bitrix IM:", e)
 
@@ -592,7 +1629,7 @@ def telegram_webhook():
 # ----------------------
 # Bitrix → Telegram: события (комментарии по задачам)
 # ----------------------
-@app.route("/bitrix/events", methods=["POST"]) 
+@bridge.route("/bitrix/events", methods=["POST"]) 
 def bitrix_events():
     data = request.get_json(silent=True) or {}
     task_id = str(data.get("taskId") or data.get("TASK_ID") or "")
@@ -603,20 +1640,22 @@ def bitrix_events():
         return jsonify({"ok": False, "error": "taskId and text are required"}), 400
 
     chat_id = _task_to_chat_map.get(task_id)
+    journal_record("in", "bitrix_task", "bitrix_events", chat_id=chat_id, task_id=task_id, author=author_id, text=text)
     if not chat_id:
         return jsonify({"ok": False, "error": "chat mapping not found for task", "task_id": task_id}), 404
 
     if TELEGRAM_BOT_TOKEN:
-        try:
-            r = requests.post(
-                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                json={"chat_id": chat_id, "text": f"Комментарий к задаче #{task_id}:\n{text}"},
-                timeout=10,
-            )
-            print("🔔 Telegram send status:", r.status_code, r.text)
-            r.raise_for_status()
-        except Exception as e:
-            return jsonify({"ok": False, "error": str(e)}), 500
+        _res, tg_err = telegram_api("sendMessage", {"chat_id": chat_id, "text": f"Комментарий к задаче #{task_id}:\n{text}"})
+        print("🔔 Telegram send status:", "ok" if not tg_err else tg_err)
+        journal_record(
+            "out", "telegram", "bitrix_events",
+            chat_id=chat_id,
+            task_id=task_id,
+            text=text,
+            status="error" if tg_err else "ok",
+        )
+        if tg_err:
+            return jsonify({"ok": False, "error": tg_err.get("error_description") or tg_err}), 500
 
     return jsonify({"ok": True})
 
@@ -624,14 +1663,18 @@ def bitrix_events():
 # ----------------------
 # Telegram: helper to set webhook to this server
 # ----------------------
-@app.route("/telegram/set_webhook", methods=["POST", "GET"]) 
+@admin.route("/telegram/set_webhook", methods=["POST", "GET"]) 
 def telegram_set_webhook():
     if not TELEGRAM_BOT_TOKEN:
         return jsonify({"ok": False, "error": "TELEGRAM_BOT_TOKEN is not set"}), 500
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook"
+    url = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}/setWebhook"
     webhook_url = f"{RENDER_URL}/telegram/webhook"
     try:
-        r = requests.post(url, json={"url": webhook_url}, timeout=10)
+        webhook_params = {"url": webhook_url}
+        if TELEGRAM_WEBHOOK_SECRET:
+            # Telegram будет присылать его в X-Telegram-Bot-Api-Secret-Token
+            webhook_params["secret_token"] = TELEGRAM_WEBHOOK_SECRET
+        r = requests.post(url, json=webhook_params, timeout=10)
         return jsonify({
             "ok": r.ok,
             "status_code": r.status_code,
@@ -645,7 +1688,7 @@ def telegram_set_webhook():
 # ----------------------
 # Bitrix IM Bot: register, status, events
 # ----------------------
-@app.route("/bot/status", methods=["GET"]) 
+@admin.route("/bot/status", methods=["GET"]) 
 def bot_status():
     access_token, rest_base, raw = load_oauth_tokens()
     return jsonify({
@@ -655,7 +1698,7 @@ def bot_status():
         "events_url": f"{RENDER_URL}/bot/events",
     })
 
-@app.route("/bot/register", methods=["POST", "GET"]) 
+@admin.route("/bot/register", methods=["POST", "GET"]) 
 def bot_register():
     # Регистрируем IM бота, чтобы получать ONIMBOTMESSAGEADD на /bot/events
     new_id = register_bot()
@@ -663,7 +1706,19 @@ def bot_register():
         return jsonify({"ok": False, "error": "bot_register_failed"}), 400
     return jsonify({"ok": True, "bot_id": new_id})
 
-@app.route("/bot/update", methods=["POST", "GET"]) 
+def _bot_event_handlers() -> dict:
+    # Когда offline-привязка подтверждена, ONIMBOTMESSAGEADD приходит через event.offline.get —
+    # push-обработчик не ставим, иначе каждое сообщение переслали бы в Telegram дважды
+    handlers = {
+        "EVENT_WELCOME_MESSAGE": f"{RENDER_URL}/bot/events",
+        "EVENT_BOT_DELETE": f"{RENDER_URL}/bot/events",
+    }
+    if not (_enabled(BITRIX_OFFLINE_EVENTS) and _offline_events_state["bound"]):
+        handlers["EVENT_MESSAGE_ADD"] = f"{RENDER_URL}/bot/events"
+    return handlers
+
+
+@admin.route("/bot/update", methods=["POST", "GET"]) 
 def bot_update():
     # Автообновление существующего бота (по умолчанию BOT_ID=19508) на наш /bot/events
     if request.method == "POST":
@@ -673,9 +1728,7 @@ def bot_update():
         bot_id = int(request.args.get("BOT_ID") or request.args.get("bot_id") or 19508)
 
     fields = {
-        "EVENT_MESSAGE_ADD": f"{RENDER_URL}/bot/events",
-        "EVENT_WELCOME_MESSAGE": f"{RENDER_URL}/bot/events",
-        "EVENT_BOT_DELETE": f"{RENDER_URL}/bot/events",
+        **_bot_event_handlers(),
         "OPENLINE": "N",
         "PROPERTIES": {
             "NAME": "Бот техподдержки",
@@ -691,7 +1744,7 @@ def bot_update():
         return jsonify({"ok": False, "error": err}), 400
     return jsonify({"ok": True, "result": result, "bot_id": bot_id})
 
-@app.route("/bot/reinstall", methods=["POST", "GET"]) 
+@admin.route("/bot/reinstall", methods=["POST", "GET"]) 
 def bot_reinstall():
     # Принудительная переустановка бота: unregister + register
     try:
@@ -713,7 +1766,7 @@ def bot_reinstall():
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-@app.route("/bot/events", methods=["POST", "GET"]) 
+@bridge.route("/bot/events", methods=["POST", "GET"]) 
 def bot_events():
     if request.method == "GET":
         return jsonify({"ok": True, "message": "bot events endpoint is up"})
@@ -733,6 +1786,20 @@ def bot_events():
         except Exception:
             pass
 
+    event = body.get("event") or ""
+    if isinstance(event, list):
+        event = event[0] if event else ""
+    if event == "ONIMBOTMESSAGEADD" and _enabled(BITRIX_OFFLINE_EVENTS) and _offline_events_state["bound"]:
+        # Бот ещё со старым push-обработчиком: это же сообщение заберёт опрос offline-очереди
+        return jsonify({"ok": True, "skipped": "offline_events"})
+
+    handle_bot_event(body)
+    return jsonify({"ok": True})
+
+
+def handle_bot_event(body: dict, source: str = "bot_events") -> bool:
+    # Общий обработчик событий бота: push на /bot/events и offline-опрос (event.offline.get).
+    # Возвращает False, если событие не удалось доставить и его стоит обработать повторно
     print(f"\n====== 📥 ПРИШЛО СООБЩЕНИЕ ОТ BITRIX БОТА {BITRIX_BOT_ID} ({BITRIX_BOT_NAME}) ======")
     print(json.dumps(body, ensure_ascii=False, indent=2))
     print("===========================================\n")
@@ -750,45 +1817,558 @@ def bot_events():
         text = (msg.get("TEXT") or msg.get("text") or "").strip()
         dialog_id = msg.get("DIALOG_ID") or msg.get("CHAT_ID") or data.get("DIALOG_ID")
         from_id = msg.get("FROM_USER_ID") or data.get("FROM_USER_ID")
+        if text:
+            journal_record("in", "bitrix_im", source, dialog_id=dialog_id, author=from_id, text=text)
 
         if event == "ONIMBOTMESSAGEADD" and text and TELEGRAM_BOT_TOKEN and TELEGRAM_NOTIFY_CHAT_ID:
             caption = f"Сообщение от бота {BITRIX_BOT_ID} ({BITRIX_BOT_NAME}) (dialog={dialog_id}, from={from_id}):\n{text}"
-            try:
-                r = requests.post(
-                    f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                    json={"chat_id": TELEGRAM_NOTIFY_CHAT_ID, "text": caption},
-                    timeout=10,
-                )
-                print("🔔 Telegram forward status:", r.status_code, r.text)
-            except Exception as e:
-                print("⚠️ Ошибка форварда в Telegram:", e)
+            _res, tg_err = telegram_api("sendMessage", {"chat_id": TELEGRAM_NOTIFY_CHAT_ID, "text": caption})
+            journal_record(
+                "out", "telegram", source,
+                chat_id=TELEGRAM_NOTIFY_CHAT_ID,
+                dialog_id=dialog_id,
+                text=text,
+                status="error" if tg_err else "ok",
+            )
+            if tg_err:
+                print("⚠️ Ошибка форварда в Telegram:", tg_err)
+                return False
+            print("🔔 Telegram forward status: ok")
     except Exception as e:
         print("⚠️ Исключение при обработке событий Bitrix:", e)
+        return False
+    return True
+
+
+# ----------------------
+# Offline-события Bitrix: пакетный опрос event.offline.get вместо push на RENDER_URL
+# ----------------------
+_offline_events_state: dict = {
+    "started": False,
+    "bound": False,  # event.bind(offline) подтверждён — только тогда push ONIMBOTMESSAGEADD не нужен
+    "bind_error": None,
+    "polls": 0,
+    "received": 0,
+    "processed": 0,
+    "failed": 0,
+    "retried": 0,
+    "last_poll_at": None,
+    "last_error_poll_at": None,
+    "last_batch": 0,
+    "last_error": None,
+}
+_offline_events_lock = threading.Lock()
+
+
+def poll_offline_events_once(errors: bool = False) -> dict:
+    # errors=True — забрать события, ранее помеченные event.offline.error, и попробовать ещё раз
+    with _offline_events_lock, priority_scope("notification"):
+        result, err = bitrix_call("event.offline.get", {
+            "clear": 0,
+            "limit": OFFLINE_EVENTS_BATCH,
+            "error": 1 if errors else 0,
+        })
+        _offline_events_state["polls"] += 1
+        _offline_events_state["last_error_poll_at" if errors else "last_poll_at"] = datetime.now().isoformat()
+        if err:
+            _offline_events_state["last_error"] = err
+            return {"ok": False, "error": err}
+        result = result if isinstance(result, dict) else {}
+        events = result.get("events") or []
+        process_id = result.get("process_id")
+
+        done, failed = [], []
+        for ev in events:
+            body = {
+                "event": ev.get("EVENT_NAME") or "",
+                "data": ev.get("EVENT_DATA") or {},
+                "offline": {"id": ev.get("ID"), "timestamp": ev.get("TIMESTAMP_X")},
+            }
+            (done if handle_bot_event(body, source="offline_events") else failed).append(ev)
+
+        # Удаляем из очереди портала только успешно обработанные события
+        clear_err = None
+        if done:
+            _res, clear_err = bitrix_call("event.offline.clear", {
+                "process_id": process_id,
+                "id": [ev.get("ID") for ev in done],
+            })
+            if clear_err:
+                print("⚠️ event.offline.clear не выполнен, события придут повторно:", clear_err)
+        # Неудачные помечаем ошибкой — иначе они остаются закреплены за process_id и не выдаются снова;
+        # помеченные забираем отдельным опросом с error: 1 (см. _offline_events_loop)
+        mark_err = None
+        if failed:
+            _res, mark_err = bitrix_call("event.offline.error", {
+                "process_id": process_id,
+                "message_id": [ev.get("MESSAGE_ID") for ev in failed],
+            })
+            if mark_err:
+                print("⚠️ event.offline.error не выполнен:", mark_err)
+
+        _offline_events_state["received"] += len(events)
+        _offline_events_state["processed"] += len(done)
+        _offline_events_state["failed"] += len(failed)
+        if errors:
+            _offline_events_state["retried"] += len(events)
+        _offline_events_state["last_batch"] = len(events)
+        _offline_events_state["last_error"] = clear_err or mark_err
+        return {
+            "ok": not (clear_err or mark_err),
+            "received": len(events),
+            "processed": len(done),
+            "failed": len(failed),
+        }
+
+
+def bind_offline_events() -> bool:
+    # Просим портал складывать ONIMBOTMESSAGEADD в очередь event.offline.get
+    if _offline_events_state["bound"]:
+        return True
+    _res, err = bitrix_call("event.bind", {"event": "ONIMBOTMESSAGEADD", "event_type": "offline"}, priority="notification")
+    if err and "already" not in str(err.get("error_description", "")).lower():
+        _offline_events_state["bind_error"] = err
+        print("⚠️ event.bind (offline) не выполнен, сообщения идут через push на /bot/events:", err)
+        return False
+    _offline_events_state["bound"] = True
+    _offline_events_state["bind_error"] = None
+    print("✅ Offline-события: ONIMBOTMESSAGEADD привязан к очереди")
+    return True
+
+
+def _offline_events_loop():
+    last_error_poll = time.monotonic()
+    while True:
+        try:
+            # Без подтверждённой привязки очередь пуста — повторяем bind на каждом круге
+            if not bind_offline_events():
+                time.sleep(OFFLINE_EVENTS_POLL_SEC)
+                continue
+            outcome = poll_offline_events_once()
+            if time.monotonic() - last_error_poll >= OFFLINE_EVENTS_ERROR_RETRY_SEC:
+                last_error_poll = time.monotonic()
+                poll_offline_events_once(errors=True)
+        except Exception as e:
+            _offline_events_state["last_error"] = str(e)
+            print("⚠️ Исключение при опросе offline-событий:", e)
+            outcome = {"ok": False}
+        # Полная пачка — в очереди, вероятно, есть ещё: забираем сразу, без паузы
+        if outcome.get("ok") and outcome.get("received", 0) >= OFFLINE_EVENTS_BATCH:
+            continue
+        time.sleep(OFFLINE_EVENTS_POLL_SEC)
+
+
+def _start_offline_events_consumer():
+    if _offline_events_state["started"]:
+        return
+    _offline_events_state["started"] = True
+    threading.Thread(target=_offline_events_loop, daemon=True).start()
+    print(f"📬 Offline-события: опрос event.offline.get каждые {OFFLINE_EVENTS_POLL_SEC} с, пачка {OFFLINE_EVENTS_BATCH}")
+
+
+@admin.route("/debug/offline_events", methods=["GET", "POST"])
+def debug_offline_events():
+    if request.method == "POST":
+        return jsonify(poll_offline_events_once(errors=request.args.get("errors") == "1"))
+    return jsonify({
+        "ok": True,
+        "enabled": _enabled(BITRIX_OFFLINE_EVENTS),
+        "batch": OFFLINE_EVENTS_BATCH,
+        "poll_sec": OFFLINE_EVENTS_POLL_SEC,
+        "error_retry_sec": OFFLINE_EVENTS_ERROR_RETRY_SEC,
+        **_offline_events_state,
+    })
+
+# ----------------------
+# Журнал переписки: запись пачками в фоне (SQLite + FTS5), поиск /history/search
+# ----------------------
+_journal_queue: "queue.Queue[tuple | None]" = queue.Queue(maxsize=JOURNAL_QUEUE_MAX)
+_journal_state: dict = {"started": False, "fts": None, "written": 0, "dropped": 0, "batches": 0, "last_error": None}
+_journal_lock = threading.Lock()
+_JOURNAL_COLUMNS = ("ts", "direction", "channel", "source", "chat_id", "task_id", "dialog_id", "author", "status", "text")
+_JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    direction TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    source TEXT,
+    chat_id TEXT,
+    task_id TEXT,
+    dialog_id TEXT,
+    author TEXT,
+    status TEXT,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_chat_ts ON messages (chat_id, ts);
+CREATE INDEX IF NOT EXISTS messages_task_ts ON messages (task_id, ts);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+"""
+_JOURNAL_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='messages', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+END;
+"""
+
+
+def journal_record(direction: str, channel: str, source: str, *, chat_id=None, task_id=None, dialog_id=None,
+                   author=None, text: str = "", status: str = "ok"):
+    # На горячем пути — только постановка в очередь; запись в SQLite делает фоновый поток
+    if not _enabled(JOURNAL_ENABLED):
+        return
+    if not _journal_state["started"]:
+        _start_journal_writer()
+
+    def _s(value):
+        return None if value is None or value == "" else str(value)
+
+    row = (time.time(), direction, channel, source, _s(chat_id), _s(task_id), _s(dialog_id), _s(author), status, text or "")
+    try:
+        _journal_queue.put_nowait(row)
+    except queue.Full:
+        _journal_state["dropped"] += 1
+
+
+def _journal_connect(read_only: bool = False) -> sqlite3.Connection:
+    if read_only:
+        return sqlite3.connect(f"file:{JOURNAL_PATH}?mode=ro", uri=True, timeout=5)
+    os.makedirs(os.path.dirname(JOURNAL_PATH) or ".", mode=0o700, exist_ok=True)
+    # В журнале тексты клиентов — файл только для владельца; -wal/-shm SQLite создаёт с теми же правами
+    fd = os.open(JOURNAL_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    os.fchmod(fd, 0o600)
+    os.close(fd)
+    conn = sqlite3.connect(JOURNAL_PATH, timeout=5)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _journal_init(conn: sqlite3.Connection):
+    conn.executescript(_JOURNAL_SCHEMA)
+    try:
+        conn.executescript(_JOURNAL_FTS_SCHEMA)
+        _journal_state["fts"] = True
+    except sqlite3.OperationalError as e:
+        # SQLite без FTS5 — поиск по тексту через LIKE
+        _journal_state["fts"] = False
+        print("ℹ️ Журнал: FTS5 недоступен, полнотекстовый поиск через LIKE:", e)
+    conn.commit()
+
+
+def _journal_writer_loop():
+    try:
+        conn = _journal_connect()
+        _journal_init(conn)
+    except Exception as e:
+        _journal_state["last_error"] = str(e)
+        print("⚠️ Журнал: не удалось открыть базу:", e)
+        return
+    insert_sql = f"INSERT INTO messages ({', '.join(_JOURNAL_COLUMNS)}) VALUES ({', '.join('?' * len(_JOURNAL_COLUMNS))})"
+    stopping = False
+    while not stopping:
+        try:
+            first = _journal_queue.get(timeout=JOURNAL_FLUSH_SEC)
+        except queue.Empty:
+            continue
+        rows = []
+        item = first
+        while True:
+            if item is None:
+                stopping = True
+            else:
+                rows.append(item)
+            if len(rows) >= JOURNAL_BATCH:
+                break
+            try:
+                item = _journal_queue.get_nowait()
+            except queue.Empty:
+                break
+        if not rows:
+            continue
+        try:
+            with conn:
+                conn.executemany(insert_sql, rows)
+            _journal_state["written"] += len(rows)
+            _journal_state["batches"] += 1
+        except Exception as e:
+            _journal_state["last_error"] = str(e)
+            print("⚠️ Журнал: ошибка записи пачки:", e)
+    conn.close()
+
+
+def _journal_flush_on_exit():
+    thread = _journal_state.get("thread")
+    if thread is not None and thread.is_alive():
+        try:
+            _journal_queue.put(None, timeout=1)
+        except queue.Full:
+            return
+        thread.join(timeout=3)
+
+
+def _start_journal_writer():
+    with _journal_lock:
+        if _journal_state["started"]:
+            return
+        _journal_state["started"] = True
+        thread = threading.Thread(target=_journal_writer_loop, daemon=True)
+        _journal_state["thread"] = thread
+        thread.start()
+    atexit.register(_journal_flush_on_exit)
+
+
+def _parse_time_arg(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def _fts_query(q: str) -> str:
+    # Каждое слово — в кавычках: пользовательский ввод не ломает синтаксис FTS5
+    return " ".join('"' + token.replace('"', '""') + '"' for token in q.split())
+
+
+@admin.route("/history/search", methods=["GET"])
+def history_search():
+    q = (request.args.get("q") or "").strip()
+    try:
+        limit = max(1, min(int(request.args.get("limit", "50")), 200))
+        before_id = int(request.args["cursor"]) if request.args.get("cursor") else None
+        since = _parse_time_arg(request.args.get("since"))
+        until = _parse_time_arg(request.args.get("until"))
+    except ValueError as e:
+        return jsonify({"ok": False, "error": f"bad parameter: {e}"}), 400
+    if not os.path.exists(JOURNAL_PATH):
+        return jsonify({"ok": True, "items": [], "next_cursor": None})
+
+    columns = ", ".join(f"m.{c}" for c in ("id",) + _JOURNAL_COLUMNS)
+    sql = f"SELECT {columns} FROM messages m"
+    where, params = [], []
+    if q and _journal_state.get("fts") is not False:
+        sql += " JOIN messages_fts ON messages_fts.rowid = m.id"
+        where.append("messages_fts MATCH ?")
+        params.append(_fts_query(q))
+    elif q:
+        where.append("m.text LIKE ?")
+        params.append(f"%{q}%")
+    for field in ("chat_id", "task_id", "dialog_id", "direction", "channel"):
+        if request.args.get(field):
+            where.append(f"m.{field} = ?")
+            params.append(request.args[field])
+    if since is not None:
+        where.append("m.ts >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("m.ts < ?")
+        params.append(until)
+    if before_id is not None:
+        where.append("m.id < ?")
+        params.append(before_id)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY m.id DESC LIMIT ?"
+    params.append(limit)
+
+    try:
+        conn = _journal_connect(read_only=True)
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    items = []
+    for row in rows:
+        item = dict(zip(("id",) + _JOURNAL_COLUMNS, row))
+        item["time"] = datetime.fromtimestamp(item["ts"]).isoformat()
+        items.append(item)
+    return jsonify({
+        "ok": True,
+        "items": items,
+        "next_cursor": items[-1]["id"] if len(items) == limit else None,
+    })
+
+
+@admin.route("/debug/journal", methods=["GET"])
+def debug_journal():
+    return jsonify({
+        "ok": True,
+        "enabled": _enabled(JOURNAL_ENABLED),
+        "path": JOURNAL_PATH,
+        "queued": _journal_queue.qsize(),
+        **{k: v for k, v in _journal_state.items() if k != "thread"},
+    })
+
+
+# ----------------------
+# Запись трафика для replay.py: очищенные от секретов вебхуки в gzip JSON lines
+# ----------------------
+_capture_queue: "queue.Queue[dict | None]" = queue.Queue(maxsize=10000)
+_capture_state: dict = {"started": False, "captured": 0, "dropped": 0, "last_error": None}
+_capture_lock = threading.Lock()
+_SENSITIVE_KEYS = {"auth", "application_token", "access_token", "refresh_token", "secret_token", "client_secret"}
+# Персональные данные: текст сообщений, имена, контакты (Telegram from/chat/contact, Bitrix data[USER], data[PARAMS])
+_PII_KEYS = {
+    "text", "caption", "message", "first_name", "last_name", "username", "name", "second_name",
+    "phone_number", "phone", "email", "vcard", "work_position",
+}
+
+
+def _mask(value: str) -> str:
+    # Та же длина — размер тел при воспроизведении не меняется, а содержимое не восстановить
+    return "x" * len(value)
+
+
+def _sanitize(value):
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            key = str(k).lower()
+            if key in _SENSITIVE_KEYS:
+                out[k] = "***"
+            elif key in _PII_KEYS and isinstance(v, str):
+                out[k] = _mask(v)
+            else:
+                out[k] = _sanitize(v)
+        return out
+    if isinstance(value, list):
+        return [_sanitize(v) for v in value]
+    return value
+
+
+def _sanitize_pairs(pairs: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    # auth[application_token], auth[access_token] и т.п. — выбрасываем целиком;
+    # data[PARAMS][MESSAGE], data[USER][NAME] и т.п. — маскируем по последнему сегменту ключа
+    out = []
+    for k, v in pairs:
+        if k.split("[", 1)[0].lower() in _SENSITIVE_KEYS:
+            continue
+        leaf = k.rsplit("[", 1)[-1].rstrip("]").lower()
+        out.append((k, _mask(v) if leaf in _PII_KEYS else v))
+    return out
+
+
+def _capture_request():
+    if not CAPTURE_PATH or request.method != "POST" or request.endpoint not in _GUARDED_ENDPOINTS:
+        return
+    content_type = request.content_type or ""
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        # Форму могла уже разобрать проверка токена — берём из request.form, а не из потока
+        body = urlencode(_sanitize_pairs(list(request.form.items(multi=True))))
+    else:
+        raw = request.get_data(cache=True)
+        try:
+            body = json.dumps(_sanitize(json.loads(raw or b"null")), ensure_ascii=False)
+        except ValueError:
+            body = ""  # не JSON и не форма — очистить не можем, тело не пишем
+    record = {
+        "t": time.time(),
+        "method": request.method,
+        "path": request.path,
+        "query": urlencode(_sanitize_pairs(parse_qsl(request.query_string.decode("utf-8", errors="replace")))),
+        "content_type": content_type,
+        "body": body,
+    }
+    if not _capture_state["started"]:
+        _start_capture_writer()
+    try:
+        _capture_queue.put_nowait(record)
+    except queue.Full:
+        _capture_state["dropped"] += 1
+
+
+def _capture_writer_loop():
+    stopping = False
+    while not stopping:
+        records = [_capture_queue.get()]
+        while len(records) < 1000:
+            try:
+                records.append(_capture_queue.get_nowait())
+            except queue.Empty:
+                break
+        if None in records:
+            stopping = True
+            records = [r for r in records if r is not None]
+        if not records:
+            continue
+        try:
+            # Каждая пачка — отдельный gzip-член: файл можно дописывать и читать gzip.open целиком
+            with open(CAPTURE_PATH, "ab") as f, gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                for r in records:
+                    gz.write((json.dumps(r, ensure_ascii=False) + "\n").encode("utf-8"))
+            _capture_state["captured"] += len(records)
+        except Exception as e:
+            _capture_state["last_error"] = str(e)
+            print("⚠️ Ошибка записи трафика:", e)
+
+
+def _capture_flush_on_exit():
+    thread = _capture_state.get("thread")
+    if thread is not None and thread.is_alive():
+        try:
+            _capture_queue.put(None, timeout=1)
+        except queue.Full:
+            return
+        thread.join(timeout=3)
+
+
+def _start_capture_writer():
+    with _capture_lock:
+        if _capture_state["started"]:
+            return
+        _capture_state["started"] = True
+        thread = threading.Thread(target=_capture_writer_loop, daemon=True)
+        _capture_state["thread"] = thread
+        thread.start()
+    atexit.register(_capture_flush_on_exit)
+    print(f"🎙️ Запись входящих вебхуков в {CAPTURE_PATH}")
+
+
+@admin.route("/debug/capture", methods=["GET"])
+def debug_capture():
+    return jsonify({
+        "ok": True,
+        "enabled": bool(CAPTURE_PATH),
+        "path": CAPTURE_PATH,
+        "queued": _capture_queue.qsize(),
+        **{k: v for k, v in _capture_state.items() if k != "thread"},
+    })
 
-    return jsonify({"ok": True})
 
 # ----------------------
 # Diagnostics: view and manage chat↔task mappings
 # ----------------------
-@app.route("/debug/mappings", methods=["GET"]) 
+@admin.route("/debug/mappings", methods=["GET"]) 
 def debug_mappings():
+    with _mapping_lock:
+        task_to_chat = dict(_task_to_chat_map)
+        chat_to_task = dict(_chat_to_task_map)
+        chat_predecessor = dict(_chat_predecessor)
     return jsonify({
-        "task_to_chat": _task_to_chat_map,
-        "chat_to_task": _chat_to_task_map,
+        "task_to_chat": task_to_chat,
+        "chat_to_task": chat_to_task,
+        "chat_predecessor": chat_predecessor,
         "note": "Для сброса используйте /chat/reset?chat_id=...; для привязки /chat/bind?chat_id=...&task_id=..."
     })
 
-@app.route("/chat/reset", methods=["GET"]) 
+@admin.route("/chat/reset", methods=["GET"]) 
 def chat_reset():
     chat_id = request.args.get("chat_id")
     if not chat_id:
         return jsonify({"ok": False, "error": "chat_id is required"}), 400
-    task_id = _chat_to_task_map.pop(str(chat_id), None)
-    if task_id:
-        _task_to_chat_map.pop(str(task_id), None)
+    with _mapping_lock:
+        task_id = _chat_to_task_map.pop(str(chat_id), None)
+        if task_id:
+            _task_to_chat_map.pop(str(task_id), None)
+        _chat_predecessor.pop(str(chat_id), None)
     return jsonify({"ok": True, "cleared": {"chat_id": chat_id, "task_id": task_id}})
 
-@app.route("/chat/bind", methods=["GET", "POST"]) 
+@admin.route("/chat/bind", methods=["GET", "POST"]) 
 def chat_bind():
     if request.method == "POST":
         data = request.get_json(silent=True) or {}
@@ -799,11 +2379,178 @@ def chat_bind():
         task_id = request.args.get("task_id") or ""
     if not chat_id or not task_id:
         return jsonify({"ok": False, "error": "chat_id and task_id are required"}), 400
-    _chat_to_task_map[str(chat_id)] = str(task_id)
-    _task_to_chat_map[str(task_id)] = str(chat_id)
+    with _mapping_lock:
+        _chat_to_task_map[str(chat_id)] = str(task_id)
+        _task_to_chat_map[str(task_id)] = str(chat_id)
+        _chat_predecessor.pop(str(chat_id), None)
     return jsonify({"ok": True, "bound": {"chat_id": chat_id, "task_id": task_id}})
 
 
+# ----------------------
+# Сверка привязок с порталом: закрытые/удалённые задачи, инкрементально по курсору
+# ----------------------
+_CLOSED_TASK_STATUSES = {"5", "7"}  # завершена, отклонена
+_reconcile_lock = threading.Lock()
+_reconcile_state: dict = {
+    "cursor": None,
+    "runs": 0,
+    "last_run_at": None,
+    "last_duration_ms": None,
+    "last_checked": 0,
+    "last_closed": 0,
+    "last_deleted": 0,
+    "last_pruned": 0,
+    "last_rebind_deferred": 0,
+    "last_error": None,
+    "total_pruned": 0,
+    "total_rebind_deferred": 0,
+}
+
+
+def _task_sort_key(task_id: str):
+    return (0, int(task_id), "") if task_id.isdigit() else (1, 0, task_id)
+
+
+def _reconcile_next_slice() -> list[str]:
+    with _mapping_lock:
+        known = set(_chat_to_task_map.values()) | set(_task_to_chat_map.keys())
+    task_ids = sorted(known, key=_task_sort_key)
+    cursor = _reconcile_state["cursor"]
+    if cursor is not None:
+        task_ids = [t for t in task_ids if _task_sort_key(t) > _task_sort_key(cursor)]
+    return task_ids[:RECONCILE_SLICE]
+
+
+def _fetch_task_statuses(task_ids: list[str]) -> tuple[dict[str, str | None], dict | None]:
+    # Одним batch-вызовом: до 50 команд tasks.task.list по 50 ID в каждой.
+    # Возвращаем статус только для ID из успешных команд; None — задачи нет (удалена)
+    chunks = [task_ids[i:i + 50] for i in range(0, len(task_ids), 50)]
+    cmds = {
+        f"c{n}": bitrix_batch_command("tasks.task.list", {
+            "filter": {"ID": chunk},
+            "select": ["ID", "STATUS"],
+            "start": -1,  # без подсчёта total — быстрее
+        })
+        for n, chunk in enumerate(chunks)
+    }
+    result, err = bitrix_call("batch", {"halt": 0, "cmd": cmds}, priority="bulk")
+    if err:
+        return {}, err
+    results = (result or {}).get("result") or {} if isinstance(result, dict) else {}
+    errors = (result or {}).get("result_error") or {} if isinstance(result, dict) else {}
+    statuses: dict[str, str | None] = {}
+    for n, chunk in enumerate(chunks):
+        key = f"c{n}"
+        if (isinstance(errors, dict) and key in errors) or not isinstance(results, dict) or key not in results:
+            continue  # не знаем судьбу этих задач — не трогаем их
+        tasks = (results[key] or {}).get("tasks") or [] if isinstance(results[key], dict) else []
+        found = {str(t.get("id") or t.get("ID")): str(t.get("status") or t.get("STATUS")) for t in tasks}
+        for task_id in chunk:
+            statuses[task_id] = found.get(task_id)
+    return statuses, None
+
+
+def reconcile_mappings_once() -> dict:
+    if not _reconcile_lock.acquire(blocking=False):
+        return {**_reconcile_state, "skipped": "already_running"}
+    try:
+        started = time.perf_counter()
+        task_ids = _reconcile_next_slice()
+        closed = deleted = pruned = deferred = 0
+        error = None
+        if task_ids:
+            statuses, error = _fetch_task_statuses(task_ids)
+            chats_by_task: dict[str, list[str]] = {}
+            with _mapping_lock:
+                mapped = list(_chat_to_task_map.items())
+            for chat_id, task_id in mapped:
+                chats_by_task.setdefault(task_id, []).append(chat_id)
+            for task_id, status in statuses.items():
+                if status is not None and status not in _CLOSED_TASK_STATUSES:
+                    continue
+                if status is None:
+                    deleted += 1
+                else:
+                    closed += 1
+                if RECONCILE_POLICY == "report":
+                    continue
+                chats = set(chats_by_task.get(task_id, []))
+                with _mapping_lock:
+                    mapped_chat = _task_to_chat_map.pop(task_id, None)
+                    for chat_id in chats:
+                        # Сравниваем под замком: вебхук мог уже перепривязать чат к другой задаче
+                        if _chat_to_task_map.get(chat_id) != task_id:
+                            continue
+                        del _chat_to_task_map[chat_id]
+                        if RECONCILE_POLICY == "rebind":
+                            # Задачу-продолжение не создаём сразу: закрытие не должно переоткрывать
+                            # обращение — её заведёт вебхук, если клиент напишет снова
+                            _chat_predecessor[chat_id] = task_id
+                            deferred += 1
+                if mapped_chat is not None or chats:
+                    pruned += 1
+            # Курсор двигаем только при успешном ответе; дошли до конца — начинаем сначала
+            if not error:
+                _reconcile_state["cursor"] = task_ids[-1] if len(task_ids) == RECONCILE_SLICE else None
+        else:
+            _reconcile_state["cursor"] = None
+
+        _reconcile_state.update({
+            "runs": _reconcile_state["runs"] + 1,
+            "last_run_at": datetime.now().isoformat(),
+            "last_duration_ms": round((time.perf_counter() - started) * 1000, 2),
+            "last_checked": len(task_ids),
+            "last_closed": closed,
+            "last_deleted": deleted,
+            "last_pruned": pruned,
+            "last_rebind_deferred": deferred,
+            "last_error": error,
+            "total_pruned": _reconcile_state["total_pruned"] + pruned,
+            "total_rebind_deferred": _reconcile_state["total_rebind_deferred"] + deferred,
+        })
+        if pruned or error:
+            print(f"🧹 Сверка привязок: проверено {len(task_ids)}, закрыто {closed}, удалено {deleted}, "
+                  f"отвязано {pruned}, ждут продолжения {deferred}, ошибка: {error}")
+        return dict(_reconcile_state)
+    finally:
+        _reconcile_lock.release()
+
+
+def _reconcile_loop():
+    while True:
+        time.sleep(RECONCILE_INTERVAL_SEC)
+        try:
+            with priority_scope("bulk"):
+                reconcile_mappings_once()
+        except Exception as e:
+            _reconcile_state["last_error"] = str(e)
+            print("⚠️ Исключение при сверке привязок:", e)
+
+
+def _start_reconciler():
+    if _reconcile_state.get("started"):
+        return
+    _reconcile_state["started"] = True
+    threading.Thread(target=_reconcile_loop, daemon=True).start()
+
+
+@admin.route("/debug/reconcile", methods=["GET", "POST"])
+def debug_reconcile():
+    if request.method == "POST":
+        return jsonify({"ok": True, "policy": RECONCILE_POLICY, **reconcile_mappings_once()})
+    return jsonify({
+        "ok": True,
+        "enabled": _enabled(RECONCILE_ENABLED),
+        "policy": RECONCILE_POLICY,
+        "interval_sec": RECONCILE_INTERVAL_SEC,
+        "slice": RECONCILE_SLICE,
+        "mapped_tasks": len(_task_to_chat_map),
+        "mapped_chats": len(_chat_to_task_map),
+        "awaiting_followup": len(_chat_predecessor),
+        **_reconcile_state,
+    })
+
+
 # ----------------------
 # Helpers: find existing bot by CODE
 # ----------------------
@@ -824,6 +2571,11 @@ def find_bot_id_by_code(code: str) -> str | None:
 # ----------------------
 
 def _auto_bootstrap():
+    with priority_scope("admin"):
+        _auto_bootstrap_impl()
+
+
+def _auto_bootstrap_impl():
     try:
         print("⚙️ Bootstrap: validating token and bot configuration...")
         access_token, rest_base, raw = load_oauth_tokens()
@@ -874,13 +2626,10 @@ def _auto_bootstrap():
             bot_id_int = int(str(_bot_state.get("bot_id")))
         except Exception:
             bot_id_int = None
+        if _enabled(BITRIX_OFFLINE_EVENTS):
+            bind_offline_events()  # до imbot.update: от результата зависит, нужен ли push-обработчик
         if bot_id_int is not None:
-            fields = {
-                "EVENT_MESSAGE_ADD": f"{RENDER_URL}/bot/events",
-                "EVENT_WELCOME_MESSAGE": f"{RENDER_URL}/bot/events",
-                "EVENT_BOT_DELETE": f"{RENDER_URL}/bot/events",
-            }
-            _upd, upd_err = bitrix_call("imbot.update", {"BOT_ID": bot_id_int, "FIELDS": fields})
+            _upd, upd_err = bitrix_call("imbot.update", {"BOT_ID": bot_id_int, "FIELDS": _bot_event_handlers()})
             if upd_err:
                 print("⚠️ Bootstrap: imbot.update failed:", upd_err)
             else:
@@ -888,7 +2637,6 @@ def _auto_bootstrap():
     except Exception as e:
         print("⚠️ Bootstrap exception:", e)
 
-@app.before_request
 def _maybe_run_bootstrap_once():
     global _did_bootstrap
     if not _did_bootstrap:
@@ -898,23 +2646,23 @@ def _maybe_run_bootstrap_once():
 # ----------------------
 # Любые другие пути — для отладки
 # ----------------------
-@app.route("/<path:unknown>", methods=["GET", "POST"]) 
+@bridge.route("/<path:unknown>", methods=["GET", "POST"]) 
 def catch_all(unknown):
     return f"❌ Путь '{unknown}' не обрабатывается этим сервером.", 404
 
 # Debug: list routes
-@app.route("/routes", methods=["GET"]) 
+@admin.route("/routes", methods=["GET"]) 
 def list_routes():
     try:
         rules = []
-        for r in app.url_map.iter_rules():
+        for r in current_app.url_map.iter_rules():
             rules.append({"rule": str(r), "methods": sorted(list(r.methods or []))})
         return jsonify({"ok": True, "routes": rules})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
 # Ensure /bot/send exists
-@app.route("/bot/send", methods=["POST", "GET"]) 
+@admin.route("/bot/send", methods=["POST", "GET"]) 
 def bot_send_route():
     # Используем бот ID из переменных окружения
     if request.method == "POST":
@@ -942,6 +2690,394 @@ def bot_send_route():
     return jsonify({"ok": True, "result": result, "bot_id": str(bot_id), "dialog_id": str(dialog_id)})
 
 
+# ----------------------
+# Массовая рассылка: /bot/send/bulk → job_id, доставка через batch + rate limit
+# ----------------------
+_bulk_jobs: "OrderedDict[str, dict]" = OrderedDict()
+_bulk_jobs_lock = threading.Lock()
+_bulk_rate_limiter = _TokenBucket(BULK_RATE_PER_SEC)
+
+
+def _render_template(template: str, variables: dict) -> str:
+    # Только простые подстановки {name}: доступ к атрибутам/индексам ({x.__class__}, {x[0]}) запрещён.
+    # Нет переменной — KeyError: литерал {name} не должен уйти получателю
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        parts.append(literal)
+        if field is None:
+            continue
+        if not field.isidentifier():
+            raise ValueError(f"unsupported placeholder {{{field}}}: only plain names are allowed")
+        value = variables[field]
+        value = repr(value) if conversion == "r" else str(value)
+        parts.append(format(value, spec) if spec else value)
+    return "".join(parts)
+
+
+def _bulk_build_recipients(body: dict) -> tuple[list[dict], str | None]:
+    template = body.get("TEMPLATE") or body.get("template")
+    common_message = body.get("MESSAGE") or body.get("message")
+    raw = body.get("RECIPIENTS") or body.get("recipients") or []
+    dialog_ids = body.get("DIALOG_IDS") or body.get("dialog_ids") or []
+    if not isinstance(raw, list) or not isinstance(dialog_ids, list):
+        return [], "recipients and dialog_ids must be lists"
+    raw = list(raw) + [{"dialog_id": d} for d in dialog_ids]
+    if not raw:
+        return [], "recipients or dialog_ids are required"
+
+    recipients = []
+    for idx, item in enumerate(raw):
+        if not isinstance(item, dict):
+            item = {"dialog_id": item}
+        dialog_id = item.get("DIALOG_ID") or item.get("dialog_id")
+        variables = item.get("VARS") or item.get("vars") or {}
+        if not isinstance(variables, dict):
+            return [], f"recipient #{idx}: vars must be an object"
+        message = item.get("MESSAGE") or item.get("message")
+        if not message and template:
+            try:
+                message = _render_template(str(template), {"dialog_id": dialog_id, **variables})
+            except KeyError as e:
+                return [], f"recipient #{idx}: missing template variable {{{e.args[0]}}}"
+            except (ValueError, IndexError) as e:
+                return [], f"bad template: {e}"
+        message = message or common_message
+        if not dialog_id or not message:
+            return [], f"recipient #{idx}: dialog_id and message (or template) are required"
+        recipients.append({"dialog_id": str(dialog_id), "message": str(message)})
+    return recipients, None
+
+
+def _bulk_send_chunk(job: dict, bot_id: str, offset: int, chunk: list[dict]):
+    cmds = {}
+    for i, rcpt in enumerate(chunk):
+        cmds[f"m{offset + i}"] = bitrix_batch_command("im.message.add", {
+            "BOT_ID": bot_id,
+            "CLIENT_ID": BITRIX_BOT_CLIENT_ID,
+            "DIALOG_ID": rcpt["dialog_id"],
+            "MESSAGE": rcpt["message"],
+        })
+    _bulk_rate_limiter.acquire()
+    result, err = bitrix_call("batch", {"halt": 0, "cmd": cmds}, priority="bulk")
+    results = (result or {}).get("result") or {} if isinstance(result, dict) else {}
+    errors = (result or {}).get("result_error") or {} if isinstance(result, dict) else {}
+    with _bulk_jobs_lock:
+        for i, rcpt in enumerate(chunk):
+            key = f"m{offset + i}"
+            outcome = {"dialog_id": rcpt["dialog_id"]}
+            if err:
+                outcome.update({"ok": False, "error": err})
+            elif isinstance(errors, dict) and key in errors:
+                outcome.update({"ok": False, "error": errors[key]})
+            elif isinstance(results, dict) and key in results:
+                outcome.update({"ok": True, "message_id": results[key]})
+            else:
+                outcome.update({"ok": False, "error": {"error": "NO_RESULT"}})
+            job["results"][offset + i] = outcome
+            job["sent" if outcome["ok"] else "failed"] += 1
+
+
+def _bulk_run_job(job: dict, bot_id: str, recipients: list[dict]):
+    job["status"] = "running"
+    job["started_at"] = datetime.now().isoformat()
+    try:
+        with ThreadPoolExecutor(max_workers=BULK_MAX_WORKERS) as pool:
+            futures = [
+                pool.submit(_bulk_send_chunk, job, bot_id, offset, recipients[offset:offset + BULK_BATCH_SIZE])
+                for offset in range(0, len(recipients), BULK_BATCH_SIZE)
+            ]
+            for f in futures:
+                f.result()
+        job["status"] = "done"
+    except Exception as e:
+        print("⚠️ Ошибка массовой рассылки:", e)
+        job["status"] = "failed"
+        job["error"] = str(e)
+    job["finished_at"] = datetime.now().isoformat()
+    print(f"📨 Рассылка {job['job_id']}: отправлено {job['sent']}, ошибок {job['failed']} из {job['total']}")
+
+
+@admin.route("/bot/send/bulk", methods=["POST"])
+def bot_send_bulk_route():
+    body = request.get_json(silent=True) or {}
+    recipients, error = _bulk_build_recipients(body)
+    if error:
+        return jsonify({"ok": False, "error": error}), 400
+    bot_id = str(body.get("BOT_ID") or body.get("bot_id") or BITRIX_BOT_ID)
+
+    job_id = uuid.uuid4().hex
+    job = {
+        "job_id": job_id,
+        "status": "queued",
+        "total": len(recipients),
+        "sent": 0,
+        "failed": 0,
+        "bot_id": bot_id,
+        "created_at": datetime.now().isoformat(),
+        "started_at": None,
+        "finished_at": None,
+        "results": [None] * len(recipients),
+    }
+    with _bulk_jobs_lock:
+        _bulk_jobs[job_id] = job
+        # Вытесняем самые старые завершённые задачи
+        while len(_bulk_jobs) > BULK_MAX_JOBS:
+            oldest_id = next((jid for jid, j in _bulk_jobs.items() if j["status"] in {"done", "failed"}), None)
+            if not oldest_id:
+                break
+            _bulk_jobs.pop(oldest_id)
+
+    threading.Thread(target=_bulk_run_job, args=(job, bot_id, recipients), daemon=True).start()
+    return jsonify({
+        "ok": True,
+        "job_id": job_id,
+        "total": len(recipients),
+        "status_url": f"/bot/send/bulk/{job_id}",
+    }), 202
+
+
+@admin.route("/bot/send/bulk/<job_id>", methods=["GET"])
+def bot_send_bulk_status(job_id):
+    with _bulk_jobs_lock:
+        job = _bulk_jobs.get(job_id)
+        if not job:
+            return jsonify({"ok": False, "error": "job not found", "job_id": job_id}), 404
+        view = {k: v for k, v in job.items() if k != "results"}
+        view["done"] = job["sent"] + job["failed"]
+        if str(request.args.get("results", "1")).lower() in {"1", "true", "yes"}:
+            view["results"] = list(job["results"])
+    return jsonify({"ok": True, **view})
+
+
+# ----------------------
+# Тёплый старт: снимок состояния (JSON + HMAC-SHA256 или sha256) при остановке и загрузка при старте
+# ----------------------
+_SNAPSHOT_MAGIC = b"BBSNAP"
+_SNAPSHOT_VERSION = 2  # v2: JSON вместо pickle — загрузка снимка не может исполнить код
+_SNAPSHOT_HEADER = struct.Struct(">6sH32s")  # magic, version, HMAC-SHA256 (или sha256) от payload
+_snapshot_info: dict = {"loaded_from": None, "loaded_at": None, "saved_at": None, "error": None, "warm_started": False}
+
+
+def _snapshot_enabled() -> bool:
+    return STATE_SNAPSHOT_ENABLED in {"1", "true", "TRUE", "yes", "on"} and bool(STATE_SNAPSHOT_PATH)
+
+
+def _collect_state() -> dict:
+    with _tg_ack_lock:
+        tg_ack = {
+            chat: {"message_id": e.get("message_id"), "suppressed": e.get("suppressed", 0)}
+            for chat, e in _tg_ack_cache.items()
+        }
+    with _mapping_lock:
+        task_to_chat = dict(_task_to_chat_map)
+        chat_to_task = dict(_chat_to_task_map)
+        chat_predecessor = dict(_chat_predecessor)
+    return {
+        "saved_at": time.time(),
+        "token_cache": dict(_memory_token_cache),
+        "task_to_chat": task_to_chat,
+        "chat_to_task": chat_to_task,
+        "chat_predecessor": chat_predecessor,
+        "bot_state": dict(_bot_state),
+        "tg_ack": tg_ack,
+        "reconcile_cursor": _reconcile_state.get("cursor"),
+    }
+
+
+def _apply_state(state: dict):
+    # Обновляем объекты на месте — на них ссылаются остальные части модуля
+    if state.get("token_cache", {}).get("access_token") and not _memory_token_cache.get("access_token"):
+        _memory_token_cache.update(state["token_cache"])
+    with _mapping_lock:
+        _task_to_chat_map.update(state.get("task_to_chat") or {})
+        _chat_to_task_map.update(state.get("chat_to_task") or {})
+        for chat, predecessor in (state.get("chat_predecessor") or {}).items():
+            if chat not in _chat_to_task_map:
+                _chat_predecessor.setdefault(chat, predecessor)
+    if state.get("bot_state", {}).get("bot_id") and not _bot_state.get("bot_id"):
+        _bot_state.update(state["bot_state"])
+    _reconcile_state["cursor"] = state.get("reconcile_cursor")
+    with _tg_ack_lock:
+        for chat, saved in (state.get("tg_ack") or {}).items():
+            entry = _tg_ack_entry(chat)
+            entry["message_id"] = entry["message_id"] or saved.get("message_id")
+            entry["suppressed"] += saved.get("suppressed", 0)
+
+
+def _snapshot_digest(payload) -> bytes:
+    if STATE_SNAPSHOT_SECRET:
+        return hmac.new(STATE_SNAPSHOT_SECRET.encode("utf-8"), payload, hashlib.sha256).digest()
+    return hashlib.sha256(payload).digest()
+
+
+def save_state_snapshot() -> bool:
+    if not _snapshot_enabled():
+        return False
+    try:
+        payload = json.dumps(_collect_state(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        header = _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, _snapshot_digest(payload))
+        os.makedirs(os.path.dirname(STATE_SNAPSHOT_PATH) or ".", mode=0o700, exist_ok=True)
+        tmp_path = f"{STATE_SNAPSHOT_PATH}.tmp"
+        # В снимке OAuth-токены — файл доступен только владельцу (0600), независимо от umask
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, STATE_SNAPSHOT_PATH)  # атомарная замена — не оставляем половину файла
+        _snapshot_info["saved_at"] = datetime.now().isoformat()
+        print(f"💾 Снимок состояния сохранён: {STATE_SNAPSHOT_PATH} ({len(payload)} байт)")
+        return True
+    except Exception as e:
+        _snapshot_info["error"] = str(e)
+        print("⚠️ Не удалось сохранить снимок состояния:", e)
+        return False
+
+
+def load_state_snapshot() -> bool:
+    if not _snapshot_enabled() or not os.path.exists(STATE_SNAPSHOT_PATH):
+        return False
+    try:
+        with open(STATE_SNAPSHOT_PATH, "rb") as f:
+            st = os.fstat(f.fileno())
+            # Чужой или доступный на запись другим файл не загружаем — его могли подменить
+            if st.st_uid != os.getuid() or st.st_mode & 0o022:
+                raise ValueError("snapshot file must be owned by this user and not group/world-writable")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, version, digest = _SNAPSHOT_HEADER.unpack_from(mm, 0)
+                if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+                    raise ValueError(f"unsupported snapshot format (magic={magic!r}, version={version})")
+                payload = mm[_SNAPSHOT_HEADER.size:]
+        if not hmac.compare_digest(_snapshot_digest(payload), digest):
+            raise ValueError("snapshot signature/checksum mismatch")
+        state = json.loads(payload)
+        if not isinstance(state, dict):
+            raise ValueError("snapshot payload must be an object")
+        _apply_state(state)
+        _snapshot_info["loaded_from"] = STATE_SNAPSHOT_PATH
+        _snapshot_info["loaded_at"] = datetime.now().isoformat()
+        print(f"♻️ Снимок состояния загружен: {len(_chat_to_task_map)} привязок, bot_id={_bot_state.get('bot_id')}")
+        return True
+    except Exception as e:
+        _snapshot_info["error"] = str(e)
+        print("⚠️ Снимок состояния не загружен, стартуем с пустым состоянием:", e)
+        return False
+
+
+def _install_shutdown_hooks():
+    atexit.register(save_state_snapshot)
+    # SIGTERM по умолчанию завершает процесс без atexit — превращаем его в SystemExit
+    try:
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def _on_sigterm(signum, frame):
+            if callable(previous):
+                previous(signum, frame)
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, _on_sigterm)
+    except ValueError:
+        # Не главный поток (например, импорт внутри воркера) — остаётся atexit
+        pass
+
+
+def _warm_start():
+    global _did_bootstrap
+    if _snapshot_info.get("warm_started"):
+        return
+    _snapshot_info["warm_started"] = True
+    _install_shutdown_hooks()
+    if load_state_snapshot() and _enabled(AUTO_BOOTSTRAP):
+        # Состояние уже есть — сверку с порталом выполняем в фоне, не задерживая первый запрос
+        _did_bootstrap = True
+        threading.Thread(target=_auto_bootstrap, daemon=True).start()
+
+
+@admin.route("/debug/snapshot", methods=["GET", "POST"])
+def debug_snapshot():
+    if request.method == "POST":
+        saved = save_state_snapshot()
+        return jsonify({"ok": saved, **_snapshot_info}), (200 if saved else 500)
+    return jsonify({
+        "ok": True,
+        "enabled": _snapshot_enabled(),
+        "path": STATE_SNAPSHOT_PATH,
+        "exists": bool(STATE_SNAPSHOT_PATH) and os.path.exists(STATE_SNAPSHOT_PATH),
+        **_snapshot_info,
+    })
+
+
+# ----------------------
+# Сборка приложения (app factory) и профиль старта
+# ----------------------
+
+def _enabled(flag: str | None) -> bool:
+    return str(flag or "") in {"1", "true", "TRUE", "yes", "on"}
+
+
+def _record_first_request():
+    if "first_request_ms" not in _startup_profile:
+        _startup_profile["first_request_ms"] = round((time.perf_counter() - _startup_t0) * 1000, 2)
+
+
+def _record_first_response(response):
+    if "first_response_ms" not in _startup_profile:
+        _startup_profile["first_response_ms"] = round((time.perf_counter() - _startup_t0) * 1000, 2)
+        print(f"🚀 Первый ответ через {_startup_profile['first_response_ms']} мс после старта процесса")
+    return response
+
+
+@admin.route("/debug/startup", methods=["GET"])
+def debug_startup():
+    return jsonify({
+        "ok": True,
+        "profile": _startup_profile,
+        "admin_routes": _enabled(ADMIN_ROUTES_ENABLED),
+        "auto_bootstrap": _enabled(AUTO_BOOTSTRAP),
+    })
+
+
+def create_app() -> Flask:
+    t0 = time.perf_counter()
+    flask_app = Flask(__name__)
+    # Отсев мусорных вебхуков — самым первым, до любой другой работы
+    flask_app.before_request(_webhook_guard)
+    flask_app.before_request(_record_first_request)
+    flask_app.before_request(_capture_request)
+    flask_app.before_request(_assign_request_priority)
+    flask_app.before_request(log_request_info)
+    flask_app.before_request(_trace_begin_request)
+    flask_app.after_request(_record_first_response)
+    flask_app.after_request(_trace_record_response)
+    flask_app.teardown_request(_trace_end_request)
+    flask_app.teardown_request(_reset_request_priority)
+    flask_app.register_blueprint(bridge)
+    if _enabled(ADMIN_ROUTES_ENABLED):
+        flask_app.register_blueprint(admin)
+    if _enabled(AUTO_BOOTSTRAP):
+        flask_app.before_request(_maybe_run_bootstrap_once)
+    _warm_start()
+    if _enabled(RECONCILE_ENABLED):
+        _start_reconciler()
+    if _enabled(BITRIX_OFFLINE_EVENTS):
+        _start_offline_events_consumer()
+    _startup_profile["create_app_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+    _startup_profile["ready_ms"] = round((time.perf_counter() - _startup_t0) * 1000, 2)
+    print(
+        f"🚀 Старт: импорт {_startup_profile['import_ms']} мс, "
+        f"сборка приложения {_startup_profile['create_app_ms']} мс, "
+        f"готов через {_startup_profile['ready_ms']} мс"
+    )
+    return flask_app
+
+
+# Импорт модуля целиком (зависимости + тело модуля), без сборки приложения
+_startup_profile["import_ms"] = round((time.perf_counter() - _startup_t0) * 1000, 2)
+app = create_app()
+
+
 # ----------------------
 # Запуск
 # ----------------------